@@ -0,0 +1,39 @@
+import logging
+
+from pymongo import ReplaceOne
+
+logger = logging.getLogger(__name__)
+
+ANCHOR_STRIDE = 10000
+# Blocks closer to the tip may still be orphaned: they can't be anchors
+ANCHOR_MIN_DEPTH = 100
+
+def anchor_id(chain, height):
+    """ Compact key of an anchor: chain << 32 | height """
+    return (int(chain) << 32) | height
+
+
+class AnchorIndex:
+    """ Persistent index of the hashes of the blocks by (chain, height), every stride blocks """
+
+    # Each anchor allows to walk backward from its block: a large hole can be split on the anchors
+    # into sub-ranges fetched concurrently. Anchors are filled from the headers, and only deep
+    # (already final) blocks are recorded.
+    def __init__(self, collection, stride=ANCHOR_STRIDE):
+        self.collection = collection
+        self.stride = stride
+
+    def heights(self, lower, upper):
+        """ Return the heights of the anchors in ]lower, upper] """
+        return list(range((lower // self.stride + 1) * self.stride, upper+1, self.stride))
+
+    def get(self, chain, heights):
+        """ Return the known anchors of a chain: {height:hash} """
+        ids = [anchor_id(chain, h) for h in heights]
+        return {x["height"]:x["hash"] for x in self.collection.find({"_id":{"$in":ids}})}
+
+    def add(self, chain, anchors):
+        """ Record anchors of a chain: {height:hash} """
+        if anchors:
+            self.collection.bulk_write([ReplaceOne({"_id":anchor_id(chain, h)}, {"height":h, "hash":block_hash}, upsert=True)
+                                        for h, block_hash in anchors.items()], ordered=False)
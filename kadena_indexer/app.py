@@ -3,6 +3,7 @@ import asyncio
 import argparse
 
 from .indexer import Indexer
+from .supervisor import Supervisor
 
 def main():
     """ Main method of the indexer, init the loger, the indexer and run it """
@@ -10,10 +11,17 @@ def main():
     parser = argparse.ArgumentParser(prog='kadena_indexer', description='Index a Kadena Blockchain')
     parser.add_argument('config_file', help="YAML Config file")
     parser.add_argument('-d', '--debug', action='store_true')
+    parser.add_argument('--drop-stale-indexes', action='store_true', help="Drop the indexer's indexes not declared anymore")
+    parser.add_argument('-w', '--workers', type=int, default=1, help="Number of indexer processes, each one handling a subset of the chains")
     args = parser.parse_args()
 
-    logging.basicConfig(encoding='utf-8', format='%(asctime)s:%(levelname)s:%(name)s => %(message)s', level=logging.DEBUG if args.debug else logging.INFO)
-    idx = Indexer(args.config_file)
+    log_level = logging.DEBUG if args.debug else logging.INFO
+    logging.basicConfig(encoding='utf-8', format='%(asctime)s:%(levelname)s:%(name)s => %(message)s', level=log_level)
+    if args.workers > 1:
+        Supervisor(args.config_file, args.workers, log_level, args.drop_stale_indexes).run()
+        return
+
+    idx = Indexer(args.config_file, drop_stale_indexes=args.drop_stale_indexes)
     asyncio.run(idx.run())
 
 if __name__ == "__main__":
@@ -1,9 +1,12 @@
 import asyncio
+from collections import namedtuple, Counter
+from contextlib import contextmanager
 from dataclasses import dataclass
 import json
 from functools import partial
 from datetime import datetime, UTC
 import logging
+import time
 import orjson
 
 import aiohttp
@@ -16,6 +19,21 @@ logger = logging.getLogger(__name__)
 
 BLOCKS_PER_BATCH = 300
 BLOCKS_PER_REQUEST = 30
+HEADERS_PER_REQUEST = 1000
+
+# Reconnection delay of the block stream: exponential backoff
+RECONNECT_DELAY_MIN = 1.0
+RECONNECT_DELAY_MAX = 10.0
+
+# Larger stream gaps (in blocks) are not repaired at reconnection, but left to the history indexing
+GAP_REPAIR_MAX = 120
+
+# The 20 chains produce a block every 1.5s: a longer silence of the stream means that it is stalled
+STALL_TIMEOUT = 30.0
+
+
+class StreamStalled(Exception):
+    """ No block received from the stream for too long """
 
 def pact_hook(x):
     """ Pact hook for the JSON deserializer """
@@ -42,6 +60,26 @@ def decode_cb(x): return json_load(b64_decode(x))
 def decode_tx(x): return json_load(b64_decode(x[1]))
 # pylint: enable=missing-function-docstring, multiple-statements
 
+def decode_events(outputs, wanted=None):
+    """ Decode the events from the (base64) transactions outputs of a block. Only the wanted events are returned, as compact tuples:
+        (name, params, reqKey, rank). Can be run in a worker process """
+    result = []
+    rank = 0
+    for out in outputs:
+        trx = json_load(b64_decode(out))
+        for ev in trx.get("events", []):
+            name = event_fqn(ev)
+            if wanted is None or name in wanted:
+                result.append((name, ev["params"], trx["reqKey"], rank))
+            rank += 1
+    return result
+
+
+# Reference to a block (ie: from a cut), usable as an anchor to fetch its ancestors
+BlockRef = namedtuple("BlockRef", ["chain", "height", "block_hash"])
+
+# Options of the blocks stream (see ChainWeb)
+StreamOptions = namedtuple("StreamOptions", ["fallback_nodes", "stall_timeout", "headers_only"], defaults=[(), STALL_TIMEOUT, False])
 
 @dataclass
 class Event:
@@ -55,6 +93,11 @@ class Event:
     height:int
     ts:datetime
 
+    @property
+    def uid(self):
+        """ Deterministic identifier of the event, stable across re-indexings """
+        return "{}:{}:{:d}".format(self.chain, self.block, self.rank)
+
 
 class ChainWebBlock:
     """ Reprensent a Kadena / Chainweb block """
@@ -64,25 +107,57 @@ class ChainWebBlock:
         self.parent =  data["header"]["parent"]
         self.chain = str(data["header"]["chainId"])
         self.ts = datetime.fromtimestamp(data["header"]["creationTime"]/1e6, UTC)
-        self.payload = data["payloadWithOutputs"]
+        self.payload_hash = data["header"].get("payloadHash")
+        # None for a block coming from the headers stream, whose payload has not been fetched
+        self.payload = data.get("payloadWithOutputs")
+        self._events = None
+        # Durations of the processing stages of the block (see tracing), and size of its payload
+        self.timings = {}
+        self.size = 0
+
+    @property
+    def has_payload(self):
+        """ Return true if the payload of the block is known """
+        return self.payload is not None
 
     def transactions_output(self):
         """ Return the transactions output of the block """
+        if self.payload is None:
+            return
         yield decode_cb(self.payload["coinbase"])
         yield from map(decode_tx, self.payload["transactions"])
 
+    def outputs(self):
+        """ Return the raw (base64) transactions outputs of the block, coinbase first """
+        if self.payload is None:
+            return []
+        return [self.payload["coinbase"]] + [x[1] for x in self.payload["transactions"]]
+
+    def set_events(self, decoded):
+        """ Set the events of the block, from already decoded tuples (see decode_events) """
+        self._events = [Event(name, params, reqKey, self.chain, self.block_hash, rank, self.height, self.ts) for (name, params, reqKey, rank) in decoded]
+
     def events(self):
-        """ Return all the events emitted by the block """
-        rank = 0
-        for trx in self.transactions_output():
-            for ev in trx.get("events", []):
-                yield Event(event_fqn(ev),ev["params"], trx["reqKey"] , self.chain, self.block_hash, rank, self.height, self.ts)
-                rank += 1
+        """ Return all the events emitted by the block (or only the wanted ones when they have been decoded beforehand) """
+        if self._events is None:
+            start = time.perf_counter()
+            self.set_events(decode_events(self.outputs()))
+            self.timings["decode"] = time.perf_counter() - start
+        return iter(self._events)
 
 class ChainWeb:
     """ Mainclass that handles all Chainweb communications stuffs """
-    def __init__(self, url):
+    # The stream is watched (see StreamOptions): when no block has been received for stall_timeout seconds, it's reconnected at once,
+    # to the next node of the list when fallback nodes are given.
+    # With headers_only, the stream carries only the blocks headers: payloads are fetched on demand.
+    # request_latency is an optional histogram (see metrics), observing the requests durations by endpoint.
+    def __init__(self, url, stream=StreamOptions(), stats=None, request_latency=None):
+        self._nodes = [url] + list(stream.fallback_nodes or [])
+        self.request_latency = request_latency
+        self.headers_only = stream.headers_only
         self._chainweb_node = url
+        self.stall_timeout = stream.stall_timeout
+        self.stats = stats if stats is not None else Counter()
         self._network = None
         self.session = None
         self.network = None
@@ -114,6 +189,46 @@ class ChainWeb:
         """ API Base URL of the node"""
         return "{:s}/chainweb/0.0/{:s}".format(self._chainweb_node, self._network)
 
+    @contextmanager
+    def _timed(self, endpoint):
+        if self.request_latency is None:
+            yield
+        else:
+            with self.request_latency.time(endpoint=endpoint):
+                yield
+
+    @property
+    def cut_url(self):
+        """ Cut URL of the node"""
+        return self.api_url + "/cut"
+
+    async def get_cut(self):
+        """ Return the current cut of the node: {chain:BlockRef} """
+        with self._timed("cut"):
+            async with self.session.get(self.cut_url) as resp:
+                data = orjson.loads(await resp.read())
+        return {chain:BlockRef(chain, x["height"], x["hash"]) for chain, x in data["hashes"].items()}
+
+    @property
+    def updates_url(self):
+        """ URL of the stream of new blocks (or headers) """
+        return self.api_url + ("/header/updates" if self.headers_only else "/block/updates")
+
+    async def get_payloads(self, chain, blocks):
+        """ Fetch (in one request) the payloads of header only blocks of a chain """
+        hashes = list({b.payload_hash for b in blocks})
+        start = time.perf_counter()
+        with self._timed("payload_batch"):
+            async with self.session.post("{:s}/chain/{:s}/payload/outputs/batch".format(self.api_url, chain), json=hashes) as resp:
+                raw = await resp.read()
+        payloads = {x["payloadHash"]:x for x in orjson.loads(raw)}
+        duration = time.perf_counter() - start
+        for b in blocks:
+            b.payload = payloads[b.payload_hash]
+            b.timings["fetch"] = b.timings.get("fetch", 0.0) + duration / len(blocks)
+            b.size += len(raw) // len(blocks)
+        self.stats["payloads_fetched"] += len(blocks)
+
     async def get_blocks(self, chain, parent, min_height, max_height):
         """ Return an iterator through a range of blocks from a chain, with the help of a parent block """
         body = {"lower":[], "upper":[parent]}
@@ -125,37 +240,131 @@ class ChainWeb:
                 if _next:
                     params["next"] = _next
 
-                async with self.session.post("{:s}/chain/{:s}/block/branch".format(self.api_url, chain), params=params, json=body) as resp:
+                start = time.perf_counter()
+                with self._timed("block_branch"):
+                    async with self.session.post("{:s}/chain/{:s}/block/branch".format(self.api_url, chain), params=params, json=body) as resp:
+                        raw = await resp.read()
+                data = orjson.loads(raw)
+                duration = time.perf_counter() - start
+                for blk in map(ChainWebBlock, data["items"]):
+                    # The page cost is shared by its blocks
+                    blk.timings["fetch"] = duration / len(data["items"])
+                    blk.size = len(raw) // len(data["items"])
+                    yield blk
+                _next = data["next"]
+
+    async def get_headers(self, chain, parent, min_height, max_height):
+        """ Return an iterator of BlockRef through a range of headers from a chain, with the help of a parent block.
+            Much cheaper than get_blocks: no payload """
+        body = {"lower":[], "upper":[parent]}
+        headers = {"Accept":"application/json;blockheader-encoding=object"}
+        _next = ""
+        while _next is not None:
+            params = {"limit":HEADERS_PER_REQUEST, "minheight":min_height, "maxheight":max_height}
+            if _next:
+                params["next"] = _next
+            with self._timed("header_branch"):
+                async with self.session.post("{:s}/chain/{:s}/header/branch".format(self.api_url, chain), params=params, json=body, headers=headers) as resp:
                     data = orjson.loads(await resp.read())
-                    for blk in map(ChainWebBlock, data["items"]):
-                        yield blk
-                    _next = data["next"]
+            for x in data["items"]:
+                yield BlockRef(chain, x["height"], x["hash"])
+            _next = data["next"]
 
-    @staticmethod
-    async def _parse_block_stream(content):
+    def _failover(self):
+        """ Switch to the next node """
+        if len(self._nodes) > 1:
+            self._nodes.append(self._nodes.pop(0))
+            self._chainweb_node = self._nodes[0]
+            self.stats["node_failovers"] += 1
+            logger.warning("Switching to node {}".format(self._chainweb_node))
+
+    async def _parse_block_stream(self, content):
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.stall_timeout
         while True:
-            data = await content.readline()
+            try:
+                # Keep-alive lines don't reset the watchdog: only blocks do
+                data = await asyncio.wait_for(content.readline(), max(deadline - loop.time(), 0.0))
+            except asyncio.TimeoutError:
+                raise StreamStalled("No block received for {:.0f}s".format(self.stall_timeout)) from None
             record = data.strip().split(b":", 1)
             if len(record) == 2  and record[0] == b"data":
-                yield ChainWebBlock(json.loads(record[1]))
+                # The download can't be told apart from the waiting for the next block: only the parsing is measured
+                start = time.perf_counter()
+                blk = ChainWebBlock(json.loads(record[1]))
+                blk.timings["parse"] = time.perf_counter() - start
+                blk.size = len(data)
+                yield blk
+                # The time spent by the consumer doesn't count
+                deadline = loop.time() + self.stall_timeout
+
+    async def _repair_gap(self, blk, last_height):
+        """ Return (in ascending order) the blocks missed by the stream between last_height and blk """
+        if blk.height - last_height > GAP_REPAIR_MAX:
+            logger.warning("Chain {:<2}: Stream gap {:d} -> {:d} too large: left to the history indexing".format(blk.chain, last_height+1, blk.height-1))
+            return []
+        try:
+            missed = [b async for b in self.get_blocks(blk.chain, blk.block_hash, last_height+1, blk.height-1)]
+        except Exception as e: # pylint: disable=broad-except
+            logger.error("Chain {:<2}: Error when repairing stream gap: {!s}".format(blk.chain, e))
+            return []
+        logger.info("Chain {:<2}: Stream gap {:d} -> {:d} repaired".format(blk.chain, last_height+1, blk.height-1))
+        return sorted(missed, key=lambda b: b.height)
 
-    async def get_new_block(self):
-        """ Return an iterator of new (streamed blocks) """
+    async def _with_payload(self, blk, payload_filter):
+        """ In headers only mode, fetch the payload of a block if payload_filter(chain, height) requires it """
+        if blk.has_payload or payload_filter is None or not payload_filter(blk.chain, blk.height):
+            return blk
+        try:
+            await self.get_payloads(blk.chain, [blk])
+        except Exception as e: # pylint: disable=broad-except
+            # Yielded without payload: the block will be indexed by the history indexing
+            logger.error("Chain {:<2}: Error when fetching payload of block {:d}: {!s}".format(blk.chain, blk.height, e))
+        return blk
+
+    async def get_new_block(self, repair_filter=None, payload_filter=None):
+        """ Return an iterator of new (streamed blocks). repair_filter(chain) tells whether the gaps of a chain must be repaired.
+            In headers only mode, the blocks are yielded without payload unless payload_filter(chain, height) is true """
+        # Height of the last block yielded, by chain. After a reconnection, the blocks produced meanwhile
+        # are fetched from the branch endpoint as soon as the first new block of their chain comes.
+        last_yielded = {}
+        delay = RECONNECT_DELAY_MIN
         while True:
             first = True
+            resumed = set()
             try:
-                async with self.session.post(self.api_url +"/block/updates") as resp:
+                async with self.session.post(self.updates_url) as resp:
                     async for blk in self._parse_block_stream(resp.content):
 
                         if first:
                             logger.info("Block stream OK")
                             first = False
+                            delay = RECONNECT_DELAY_MIN
+
+                        if blk.chain not in resumed:
+                            resumed.add(blk.chain)
+                            last_height = last_yielded.get(blk.chain)
+                            if last_height is not None and blk.parent not in self.cache and blk.height - 1 > last_height \
+                               and (repair_filter is None or repair_filter(blk.chain)):
+                                for missed in await self._repair_gap(blk, last_height):
+                                    last_yielded[blk.chain] = missed.height
+                                    yield missed
 
                         if blk.parent in self.cache:
-                            yield self.cache[blk.parent]
+                            parent = self.cache[blk.parent]
+                            last_yielded[blk.chain] = parent.height
+                            yield await self._with_payload(parent, payload_filter)
                         self.cache[blk.block_hash] = blk
 
+            except StreamStalled as e:
+                # Reconnect at once
+                logger.warning("Block stream stalled: {!s}".format(e))
+                self.stats["stream_stalls"] += 1
+                self._failover()
             except Exception:  # pylint: disable=broad-except
                 logger.exception("Error when reading block stream")
-                await asyncio.sleep(10.0)
+                self.stats["stream_errors"] += 1
+                self._failover()
+                await asyncio.sleep(delay)
+                delay = min(2*delay, RECONNECT_DELAY_MAX)
                 logger.info("Trying to reconnect")
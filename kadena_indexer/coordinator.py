@@ -25,6 +25,10 @@ def norm_range(x):
 
 ALL_CHAINS = [str(x) for x in range(0,20)]
 
+def cursors_key(chain):
+    """ Key of the document holding the fill cursors of a chain """
+    return "cursors:{}".format(chain)
+
 class Coordinator:
     """ Class that manages all events indexing states """
 
@@ -32,59 +36,177 @@ class Coordinator:
     #  - wanted: Events ranges that comes from the config
     #  - done: Events ranges already indexed.. These ranges are always narrower than wanted.
     #          This object is written in the MongoDB
-    def __init__(self, mongo_collection):
+    # When shared, several indexer instances may update the same documents: done ranges are merged on write
+    def __init__(self, mongo_collection, shared=False):
+        self.shared = shared
         self.wanted = {c:{} for c in ALL_CHAINS}
         self.done = {c:{} for c in ALL_CHAINS}
+        self.pending = {c:P.empty() for c in ALL_CHAINS}
+        self.dirty = {c:set() for c in ALL_CHAINS}
+        self.cursors = {c:{} for c in ALL_CHAINS}
+        self.listeners = []
         self.collection = mongo_collection
 
-    def register_event(self, chain, name, height_range):
-        """ Register an event to indexr for a given chain, and an height range (2-tuple) """
-        logger.info("Using {:s}/{: <2} => {!s}".format(name, chain, norm_range(height_range)))
-        self.wanted[chain][name] = P.closed(*norm_range(height_range))
+    def register_event(self, chain, name, height_range, write=True):
+        """ Register an event to indexr for a given chain, and an height range (2-tuple).
+            When write is False, the state is only read (ie: chains indexed by another process) """
+        if write:
+            logger.info("Using {:s}/{: <2} => {!s}".format(name, chain, norm_range(height_range)))
+        wanted = P.closed(*norm_range(height_range))
 
         # Get Done from MongoDB
         data = self.collection.find_one({"chain":chain, "name":name})
         done = P.from_data(data["range"]) if data is not None else P.empty()
 
-        # We intersect with Wanted
-        done &= self.wanted[chain][name]
-        self.done[chain][name] = done
+        # We intersect with Wanted. The dicts are replaced rather than updated: they may be iterated meanwhile
+        # by another thread (config reload). Done first: the readers look up the done range of each wanted event.
+        self.done[chain] = {**self.done[chain], name:done & wanted}
+        self.wanted[chain] = {**self.wanted[chain], name:wanted}
 
         #And update MongoDB just in case
-        self.collection.replace_one({"chain":chain, "name":name},  {"chain":chain, "name":name, "range":P.to_data(done)}, True)
-
-
+        if write:
+            self.dirty[chain].add(name)
+            self.checkpoint(chain)
+            self._notify(chain)
+
+    def add_listener(self, callback):
+        """ Add a callback(chain), called when blocks may be missing on a chain. It can be called from any thread """
+        self.listeners.append(callback)
+
+    def _notify(self, chain):
+        for callback in self.listeners:
+            callback(chain)
+
+    def set_tip(self, chain, height):
+        """ Notify the coordinator of the last block of a chain: listeners are notified if blocks are missing below it """
+        if not self.get_missing(chain, height-1).empty:
+            self._notify(chain)
+
+    def unregister_event(self, chain, name):
+        """ Stop indexing an event on a chain. Its done range is kept in MongoDB """
+        if name not in self.wanted[chain]:
+            return
+        logger.info("Removing {:s}/{: <2}".format(name, chain))
+        self.checkpoint(chain)
+        self.wanted[chain] = {k:v for k, v in self.wanted[chain].items() if k != name}
+        self.done[chain] = {k:v for k, v in self.done[chain].items() if k != name}
+
+    def reload(self, chain):
+        """ Merge the done ranges of a chain written in MongoDB by other instances """
+        for name, wanted in self.wanted[chain].items():
+            data = self.collection.find_one({"chain":chain, "name":name})
+            if data is not None:
+                self.done[chain][name] |= P.from_data(data["range"]) & wanted
+
+
+    def load_cursors(self, chain):
+        """ Load the fill cursors of a chain, persisted by the previous run: {height:hash} of already indexed blocks """
+        data = self.collection.find_one({"_id":cursors_key(chain)})
+        self.cursors[chain] = dict(data["cursors"]) if data is not None else {}
+
+    def save_cursors(self, chain, cursors):
+        """ Persist the fill cursors of a chain. Only the ones above a missing block are kept """
+        self.cursors[chain] = {h:block_hash for h, block_hash in cursors.items() if not self.get_missing(chain, h-1).empty}
+        self.collection.replace_one({"_id":cursors_key(chain)}, {"chain":chain, "cursors":sorted(self.cursors[chain].items())}, upsert=True)
+
+    def cursor(self, chain, height):
+        """ Return the (height, hash) of the closest known block above height, or None """
+        above = [h for h in self.cursors[chain] if h > height]
+        if not above:
+            return None
+        h = min(above)
+        return h, self.cursors[chain][h]
+
+
+    # The readers below may run in another thread than the writer (config reload): an event read from wanted may
+    # have been unregistered since, its done range being gone. It is then considered as not wanted anymore.
     def should_index_event(self, chain, name, height):
         """ Return true is the given event has to be indexed """
-        return name in self.wanted[chain] and height in self.wanted[chain][name] and not height in self.done[chain][name]
+        wanted, done = self.wanted[chain].get(name), self.done[chain].get(name)
+        return wanted is not None and done is not None and height in wanted and height not in done
 
-    def _validate_blocks(self, chain, height_range, session=None):
-        updates = []
+    def wanted_events(self, chain, height):
+        """ Return the names of the events to be indexed at a given height """
+        done = self.done[chain]
+        return frozenset(name for name, wanted in self.wanted[chain].items() if height in wanted and name in done and height not in done[name])
 
-        for (name, done), wanted in zip(self.done[chain].items(), self.wanted[chain].values()):
+    def _validate_blocks(self, chain, height_range, session=None, checkpoint=True):
+        for name, wanted in self.wanted[chain].items():
+            done = self.done[chain][name]
             new_done = (done | height_range) & wanted
             if new_done != done:
                 self.done[chain][name] = new_done
-                updates.append(ReplaceOne({"chain":chain, "name":name},  {"chain":chain, "name":name, "range":P.to_data(new_done)}, upsert=True))
-
+                self.dirty[chain].add(name)
+
+        if checkpoint:
+            self.checkpoint(chain, session=session)
+
+    def _merge_write(self, chain, name, session=None):
+        """ Write a done range, merged with the one in MongoDB. Optimistic concurrency is handled by a revision number """
+        while True:
+            data = self.collection.find_one({"chain":chain, "name":name}, session=session)
+            if data is None:
+                self.collection.replace_one({"chain":chain, "name":name},  {"chain":chain, "name":name, "range":P.to_data(self.done[chain][name]), "rev":0},
+                                            upsert=True, session=session)
+                return
+            merged = (self.done[chain][name] | P.from_data(data["range"])) & self.wanted[chain][name]
+            res = self.collection.update_one({"_id":data["_id"], "rev":data.get("rev")}, {"$set":{"range":P.to_data(merged), "rev":data.get("rev", 0)+1}},
+                                             session=session)
+            if res.matched_count:
+                self.done[chain][name] = merged
+                return
+
+    def checkpoint(self, chain, session=None):
+        """ Write to MongoDB the ranges of a chain that have been updated since the last checkpoint """
+        if self.shared:
+            for name in self.dirty[chain]:
+                self._merge_write(chain, name, session=session)
+            self.dirty[chain].clear()
+            return
+
+        updates = [ReplaceOne({"chain":chain, "name":name},  {"chain":chain, "name":name, "range":P.to_data(self.done[chain][name])}, upsert=True)
+                   for name in self.dirty[chain]]
         if updates:
             self.collection.bulk_write(updates, ordered=False, session=session)
+        self.dirty[chain].clear()
 
-    def validate_blocks(self, chain, min_height, max_height, session=None):
-        """ Notify the coordinator that a range of blocks has been indexed """
-        self._validate_blocks(chain, P.closed(min_height, max_height), session=session)
+    def validate_blocks(self, chain, min_height, max_height, session=None, checkpoint=True):
+        """ Notify the coordinator that a range of blocks has been indexed. When checkpoint is False, MongoDB is updated by a later checkpoint """
+        self._validate_blocks(chain, P.closed(min_height, max_height), session=session, checkpoint=checkpoint)
 
-    def validate_block(self, chain, height, session=None):
-        """ Notify the coordinator that a given block has been indexed """
-        self._validate_blocks(chain, P.singleton(height), session=session)
+    def validate_block(self, chain, height, session=None, checkpoint=True):
+        """ Notify the coordinator that a given block has been indexed. When checkpoint is False, MongoDB is updated by a later checkpoint """
+        self._validate_blocks(chain, P.singleton(height), session=session, checkpoint=checkpoint)
+
+    def set_pending(self, chain, height):
+        """ Notify the coordinator that a block has been queued for indexing: it's not reported as missing anymore """
+        self.pending[chain] |= P.singleton(height)
+
+    def clear_pending(self, chain, height):
+        """ Notify the coordinator that a queued block has been handled (successfully or not) """
+        self.pending[chain] -= P.singleton(height)
+        # Not indexed (ie: write failure): the block is missing again
+        if self.wanted_events(chain, height):
+            self._notify(chain)
 
     def get_missing(self, chain, max_height):
         """ Return the missing ranges (to be indexed) for a given chain """
         result = P.empty()
-        for wanted, done in zip(self.wanted[chain].values(), self.done[chain].values()):
-            result |= wanted - done
-
-        return result & P.closed(MIN_HEIGHT, max_height)
+        done = self.done[chain]
+        for name, wanted in self.wanted[chain].items():
+            if name in done:
+                result |= wanted - done[name]
+
+        return (result - self.pending[chain]) & P.closed(MIN_HEIGHT, max_height)
+
+    def is_complete(self, name):
+        """ Return true if an event has been indexed on all its chains, without any hole below the highest indexed block """
+        for chain, events in self.wanted.items():
+            if name in events:
+                done = self.done[chain][name]
+                if done.empty or not ((events[name] & P.closed(MIN_HEIGHT, done.upper)) - done).empty:
+                    return False
+        return True
 
     def get_wanted(self):
         """ Returns a flattened view of the wanted events in a list of tuples (event, chain, renge_low, range_high)"""
@@ -0,0 +1,94 @@
+import asyncio
+import logging
+import multiprocessing
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from .chainweb import decode_events
+
+logger = logging.getLogger(__name__)
+
+# Number of times a block is resubmitted after the pool broke (ie: a worker killed by the OOM killer)
+POOL_RETRIES = 3
+
+class Decoder:
+    """ Decodes the events of the blocks, in a process pool when workers > 0 """
+
+    # Only the raw transactions outputs and the names of the wanted events are sent to the workers,
+    # and only the wanted events come back. Blocks without any wanted event are not decoded at all.
+    def __init__(self, coordinator, workers=0):
+        self.coordinator = coordinator
+        self.workers = workers
+        self._executor = None
+        if workers:
+            logger.info("Starting {:d} decoding processes".format(workers))
+            self._executor = self._new_executor()
+
+    def _new_executor(self):
+        return ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context("spawn"))
+
+    def _restart(self, broken):
+        """ Replace a broken pool. The blocks in flight fail together: only the first one restarts it """
+        if self._executor is broken:
+            logger.error("Decoding process pool broken: restarting it")
+            broken.shutdown(wait=False, cancel_futures=True)
+            self._executor = self._new_executor()
+
+    def close(self):
+        """ Stop the process pool """
+        if self._executor is not None:
+            self._executor.shutdown(wait=True, cancel_futures=True)
+
+    def _submit(self, blk):
+        """ Start decoding a block: return an awaitable of the decoded events """
+        loop = asyncio.get_running_loop()
+        start = time.perf_counter()
+        wanted = self.coordinator.wanted_events(blk.chain, blk.height)
+        def decoded(_fut):
+            blk.timings["decode"] = time.perf_counter() - start
+
+        if wanted and self._executor is not None:
+            fut = asyncio.ensure_future(self._decode_in_pool(blk.outputs(), wanted))
+            # The waiting time in the pool is accounted too
+            fut.add_done_callback(decoded)
+            return fut
+
+        fut = loop.create_future()
+        fut.set_result(decode_events(blk.outputs(), wanted) if wanted else [])
+        decoded(fut)
+        return fut
+
+    async def _decode_in_pool(self, outputs, wanted):
+        """ Decode in the process pool. When the pool is broken, it is restarted and the block resubmitted """
+        for attempt in range(POOL_RETRIES+1):
+            executor = self._executor
+            try:
+                return await asyncio.get_running_loop().run_in_executor(executor, decode_events, outputs, wanted)
+            except BrokenProcessPool:
+                # A block breaking the pool every time is not retried forever
+                if attempt == POOL_RETRIES:
+                    raise
+                self._restart(executor)
+        return None
+
+    async def decode_one(self, blk):
+        """ Decode a single block """
+        blk.set_events(await self._submit(blk))
+        return blk
+
+    async def decode(self, blocks):
+        """ Decode an async iterator of blocks, with several blocks in flight. Blocks are yielded in order """
+        inflight = deque()
+        async for blk in blocks:
+            inflight.append((blk, self._submit(blk)))
+            if len(inflight) > 2*self.workers:
+                blk, fut = inflight.popleft()
+                blk.set_events(await fut)
+                yield blk
+
+        while inflight:
+            blk, fut = inflight.popleft()
+            blk.set_events(await fut)
+            yield blk
@@ -1,47 +1,226 @@
 import asyncio
 import logging
+import os
+import signal
+import time
+from contextlib import nullcontext
+from collections import defaultdict, namedtuple, Counter, OrderedDict
 from dataclasses import asdict
+from functools import partial
 
 import yaml
+from aiohttp import web
 from easydict import EasyDict
-from pymongo import MongoClient
-from .coordinator import Coordinator
-from .chainweb import ChainWeb
+from pymongo import MongoClient, WriteConcern
+from pymongo.errors import BulkWriteError, ConnectionFailure, PyMongoError
+from .coordinator import Coordinator, P, MIN_HEIGHT
+from .chainweb import ChainWeb, StreamOptions, STALL_TIMEOUT
+from .writer import Writer, WRITE_QUEUE_SIZE
+from .spool import Spool, SEGMENT_SIZE
+from .pruner import Pruner, PRUNE_CHUNK, PRUNE_RATE
+from .indexes import IndexManager
+from .store import EventStore, event_key
+from .decoder import Decoder
+from .planner import plan_fills
+from .anchors import AnchorIndex, ANCHOR_STRIDE, ANCHOR_MIN_DEPTH
+from .metrics import MetricsServer, Histogram
+from .tracing import Tracer, BlockTrace, load_exporter
+from .profiling import Profiler
+from .leases import Leases, LEASE_TTL, LEASE_SPAN, LIVE_MARGIN, chain_lease, range_lease, lease_chain, split_segments
 
 logger = logging.getLogger(__name__)
 
+DUPLICATE_KEY = 11000
+
+WriteProfile = namedtuple("WriteProfile", ["write_concern", "checkpoint"])
+BULK_LOAD_CHECK_PERIOD = 60.0
+STATS_PERIOD = 60.0
+SPOOL_RETRY_DELAY = 5.0
+# A spooled record failing that many times is moved to the quarantine
+SPOOL_MAX_ATTEMPTS = 5
+
+# Backfill is throttled when the live blocks are committed later than that (seconds after their creation).
+# A block is streamed once its child exists: the latency can't be less than a block time (30s).
+TIP_LATENCY_TARGET = 90.0
+# ... but never more than that: the stream may be stalled, and backfill must go on
+THROTTLE_MAX_WAIT = 30.0
+# While the live blocks stay late, the backfill runs for this period between the pauses
+THROTTLE_RUN_PERIOD = 10.0
+CONFIG_CHECK_PERIOD = 10.0
+CUT_REFRESH_PERIOD = 60.0
+# The fill tasks are woken up by the coordinator when blocks are missing. This is only a safety net.
+FILL_IDLE_PERIOD = 300.0
+FILL_PARALLELISM = 4
+METRICS_PORT = 9100
+
+def db_unavailable(error):
+    """ Return true if a write failed because MongoDB could not be reached, rather than because of what was written """
+    if isinstance(error, ConnectionFailure):
+        return True
+    return isinstance(error, PyMongoError) and (error.has_error_label("TransientTransactionError") or error.has_error_label("RetryableWriteError"))
+
+
 class Indexer:
     """ Main indexer class """
 
-    def __init__(self, config_file):
+    # When chains is given, only these chains are indexed (see Supervisor), the others being handled by other processes
+    def __init__(self, config_file, drop_stale_indexes=False, chains=None, stats_queue=None, worker_id=0):
         self._tips = {}
+        self.chains = chains
+        self.worker_id = worker_id
+        self.stats = Counter()
+        self.node_latency = Histogram("kadena_indexer_node_request_seconds", "Duration of the Chainweb node requests")
+        self.commit_latency = Histogram("kadena_indexer_commit_seconds", "Duration of the MongoDB writes of the blocks")
+        self.config_file = config_file
+        self._reload_requested = None
+        self._stats_queue = stats_queue
+        self.writer = None
+        self._spool_failed = asyncio.Event()
+        self._spool_inflight = OrderedDict()
+        self._spool_attempts = Counter()
+        self.tip_latency = {}
+        self._cursors = defaultdict(dict)
+        self._wakeups = defaultdict(asyncio.Event)
+        self._fill_tasks = {}
+        self._backfill_gate = None
+        self._throttle_deadline = 0.0
         self.config = self._load_config(config_file)
+        if self.config.get("write_mode", "transaction") not in ("transaction", "idempotent"):
+            raise ValueError("Unknown write_mode: {!s}".format(self.config.write_mode))
+        if self.config.get("live_mode", "blocks") not in ("blocks", "headers"):
+            raise ValueError("Unknown live_mode: {!s}".format(self.config.live_mode))
+        self.headers_only = self.config.get("live_mode") == "headers"
+        self.idempotent = self.config.get("write_mode") == "idempotent"
+        self.profiles = self._load_profiles()
+        self._unchecked = defaultdict(int)
+        self.bulk_load = bool(self.config.get("bulk_load"))
+        self._deferred_indexes = set()
+        self._unbuilt_indexes = set()
         self.mongo_client = MongoClient(self.config.mongo_uri)
         logger.info("Connected to MongoDB v{!s}".format(self.mongo_client.server_info()["version"]))
         self.db = self.mongo_client[self.config.db]
+        self.store = EventStore(self.db, bool(self.config.get("clustered_collections")), self.config.get("block_compressor", "zstd"),
+                                self.config.get("partitioned"))
+        self.indexes = IndexManager(self.store, drop_stale_indexes or bool(self.config.get("drop_stale_indexes")))
+        self.leases = self._load_leases()
+        self.lease_span = (self.config.get("leases") or {}).get("span", LEASE_SPAN)
         self.coordinator = self._load_coordinator()
+        self.spool = self._load_spool()
         self._check_indexes()
-        self._prune_db()
+        self.pruner = self._load_pruner()
+        self.decoder = Decoder(self.coordinator, self.config.get("decoders", 0))
+        self.anchors = AnchorIndex(self.db.anchors, self.config.get("anchor_stride", ANCHOR_STRIDE))
+        self.fill_parallelism = self.config.get("fill_parallelism", FILL_PARALLELISM)
+        self.tracer = self._load_tracer()
+        self.profiler = Profiler(self.config.get("profile_dir", "."))
+        self._profiling_task = None
+        self.tip_latency_target = self.config.get("tip_latency_target", TIP_LATENCY_TARGET)
 
     def _load_config(self, config_file):
         logger.info("Loading config {}".format(config_file))
         with open(config_file, "rb") as fd:
             return EasyDict(yaml.safe_load(fd))
 
+    def _load_profiles(self):
+        """ Load the durability profiles: True => live blocks, False => backfilled blocks """
+        cfg = self.config.get("durability") or {}
+        def profile(x):
+            x = x or {}
+            # None inherits the write concern of the client (ie: from the URI). An empty WriteConcern would override it.
+            wc = WriteConcern(w=x.get("w"), j=x.get("j")) if x.get("w") is not None or x.get("j") is not None else None
+            return WriteProfile(wc, x.get("checkpoint", 1))
+        return {True:profile(cfg.get("live"))._replace(checkpoint=1), False:profile(cfg.get("backfill"))}
+
+    def _load_tracer(self):
+        cfg = self.config.get("tracing")
+        if not cfg:
+            return None
+        logger.info("Tracing {:.0%} of the blocks".format(cfg.get("sample_rate", 1.0)))
+        return Tracer(load_exporter(cfg), cfg.get("sample_rate", 1.0))
+
     def _load_coordinator(self):
         logger.info("Loading coordinator")
+        # The coordinator checkpoints are always written with the live (durable) profile
+        c = Coordinator(self.db.coordinator.with_options(write_concern=self.profiles[True].write_concern), shared=self.leases is not None)
+        for ev in self.config.events:
+            for chain in filter(self._owns, ev.chains):
+                c.register_event(chain, ev.name, ev.height)
+        for chain in self._configured_chains():
+            c.load_cursors(chain)
+        return c
+
+    def _load_leases(self):
+        cfg = self.config.get("leases")
+        if not cfg:
+            return None
+        if not self.idempotent:
+            # The former holder of an expired lease may still have blocks in flight: they must be harmless when written twice
+            raise ValueError("leases require write_mode: idempotent")
+        if self.config.get("spool"):
+            # The spooled blocks are written after their lease may have been released: they would be dropped and fetched again, endlessly
+            raise ValueError("leases and spool are mutually exclusive")
+        return Leases(self.db.coordinator.with_options(write_concern=self.profiles[True].write_concern), cfg.get("instance"), cfg.get("ttl", LEASE_TTL))
+
+    def _owns(self, chain):
+        """ Return true if a chain is indexed by this indexer """
+        return self.chains is None or chain in self.chains
+
+    def _configured_chains(self):
+        return sorted({c for ev in self.config.events for c in ev.chains if self._owns(c)}, key=int)
+
+    def _indexes_live(self, chain):
+        """ Return true if the live blocks of a chain are indexed by this instance """
+        return self._owns(chain) and (self.leases is None or self.leases.holds(chain_lease(chain)))
+
+    def _holds_block(self, chain, height, live):
+        """ Return true if this instance (still) holds the lease of a block: the lease of the chain for the live blocks,
+            the one of the history segment for the others """
+        if self.leases is None:
+            return True
+        return self.leases.holds(chain_lease(chain) if live else range_lease(chain, height // self.lease_span))
+
+    def _repairs_gaps(self, chain):
+        """ Return true if the blocks missed by the stream of a chain must be fetched at once (see ChainWeb.get_new_block) """
+        return self._indexes_live(chain) and bool(self.coordinator.wanted[chain])
+
+    def _wants_payload(self, chain, height):
+        """ Return true if the payload of a live block is needed (headers only live mode) """
+        return self._indexes_live(chain) and bool(self.coordinator.wanted_events(chain, height))
+
+    def _global_coordinator(self):
+        """ Return a view of the coordinator including the chains indexed by other processes (read only for these chains) """
+        if self.chains is None:
+            return self.coordinator
         c = Coordinator(self.db.coordinator)
         for ev in self.config.events:
             for chain in ev.chains:
-                c.register_event(chain, ev.name, ev.height)
+                c.register_event(chain, ev.name, ev.height, write=False)
         return c
 
+    def _load_spool(self):
+        if not self.config.get("spool"):
+            return None
+        # Each process indexing a subset of the chains has its own spool
+        path = self.config.spool if self.chains is None else os.path.join(self.config.spool, "chains_"+"_".join(self.chains))
+        logger.info("Loading spool {}".format(path))
+        spool = Spool(path, self.config.get("spool_segment_size", SEGMENT_SIZE), self.config.get("spool_fsync", True))
+        # Spooled blocks will be replayed: they must not be fetched again
+        count = 0
+        for rec in spool.pending():
+            self.coordinator.set_pending(rec["chain"], rec["height"])
+            count += 1
+        logger.info("Spool: {:d} blocks to replay".format(count))
+        return spool
+
+    def _load_pruner(self):
+        cfg = self.config.get("prune") or {}
+        return Pruner(self.store, self.coordinator, cfg.get("chunk", PRUNE_CHUNK), cfg.get("rate", PRUNE_RATE))
+
     def _prune_db(self):
+        """ Schedule the pruning of all the events: it runs in background """
         logger.info("Pruning Database")
-        for (name, chain, lower, upper) in self.coordinator.get_wanted():
-            res = self.db[name].delete_many({"chain":chain, "$or":[{"height":{"$lt":lower}}, {"height":{"$gt":upper}}]})
-            if res.deleted_count:
-                logger.info("Pruned {:d} events for {:s}/{: <2}".format(res.deleted_count, name, chain))
+        for (name, chain, _, _) in self.coordinator.get_wanted():
+            self.pruner.schedule(name, chain)
 
     def _check_indexes(self):
         """ This checks all the reqired indexes: coordinator collection + events collection """
@@ -50,74 +229,708 @@ class Indexer:
             logger.info("Create coordinator index")
             self.db.coordinator.create_index(["name", "chain"], name="name_chain")
 
-        for ev in self.config.events:
-            coll = self.db[ev.name]
-            current_idx = coll.index_information()
-            for idx_field in ["regKey", "height", "block", "ts"]:
-                idx_name = "st_"+idx_field
-                if idx_name not in current_idx:
-                    logger.warning("{} => Index {} missing".format(ev.name, idx_name))
-                    coll.create_index(idx_field, name=idx_name)
-
-            # Special index required for pruning
-            if "st_prune" not in current_idx:
-                logger.warning("{} => Index {} missing".format(ev.name, "st_prune"))
-                coll.create_index({"chain":1, "height":1}, name="st_prune")
-
-    def _index_block(self, blk, log_height=0):
+        self._declare_events(self.config.events)
+        coordinator = self._global_coordinator() if self.bulk_load else None
+        for name in self.store.collections():
+            self.store.prepare(name)
+            # In bulk load mode, the secondary indexes are built once the events history has been indexed
+            if self.bulk_load and not self._is_complete(coordinator, name):
+                logger.info("{} => Bulk load: secondary indexes deferred".format(name))
+                self._deferred_indexes.add(name)
+                self.indexes.reconcile(name, deferred=True)
+            else:
+                # The other indexes may take a while to build on large collections: they are built in background
+                self.indexes.reconcile(name, deferred=True)
+                self._unbuilt_indexes.add(name)
+
+    def _declare_events(self, events):
+        """ Route the events to their collections, and declare their indexes """
+        for ev in events:
+            self.store.route(ev.name, ev.get("partition"))
+        self.indexes.declare({ev.name:ev.get("indexes") for ev in events})
+
+    def _unroute_events(self, names):
+        """ Forget the events removed from the config, and the collections left without any event """
+        for name in names:
+            self.store.unroute(name)
+        collections = set(self.store.collections())
+        self._deferred_indexes &= collections
+        self._unbuilt_indexes &= collections
+
+    def _events_map(self, config):
+        """ Return the events of a config handled by this indexer: {(name, chain):height} """
+        return {(ev.name, chain):ev.height for ev in config.events for chain in ev.chains if self._owns(chain)}
+
+    def _prepare_collections(self):
+        for name in self.store.collections():
+            self.store.prepare(name)
+
+    def _reconcile_indexes(self):
+        for name in self.store.collections():
+            try:
+                self.indexes.reconcile(name, deferred=name in self._deferred_indexes)
+            except Exception as e: # pylint: disable=broad-except
+                logger.error("{} => Error when building indexes: {!s}".format(name, e))
+
+    def _apply_events(self, removed, changed):
+        """ Apply the events changes to the coordinator (in the writer thread) """
+        for name, chain in removed:
+            self.coordinator.unregister_event(chain, name)
+        for (name, chain), height in changed.items():
+            self.coordinator.register_event(chain, name, height)
+
+    async def _reload_config(self):
+        """ Apply live the events changes of the config file """
+        try:
+            config = await asyncio.to_thread(self._load_config, self.config_file)
+            new = self._events_map(config)
+        except Exception as e: # pylint: disable=broad-except
+            logger.error("Invalid config, not applied: {!s}".format(e))
+            return
+
+        if any(config.get(k) != self.config.get(k) for k in set(config) | set(self.config) if k != "events"):
+            logger.warning("Config reloaded: only the events changes are applied, the other settings need a restart")
+        old = self._events_map(self.config)
+        removed = old.keys() - new.keys()
+        changed = {k:v for k, v in new.items() if old.get(k) != v}
+        # The removed events keep their route until they are not wanted anymore
+        self._declare_events(list(self.config.events) + list(config.events))
+        if removed or changed:
+            # The collections must exist before the events are wanted. The missing blocks will be fetched
+            # by the fill tasks, and the out of range events deleted by the pruner.
+            await asyncio.to_thread(self._prepare_collections)
+            await (await self.writer.submit(self._apply_events, removed, changed))
+        self._unroute_events({ev.name for ev in self.config.events} - {ev.name for ev in config.events})
+        self._declare_events(config.events)
+        # Only now: on failure, the reload is retried with the same differences
+        self.config.events = config.events
+        if not removed and not changed:
+            logger.info("Config reloaded: no events change")
+            return
+
+        for name, chain in changed:
+            self.pruner.schedule(name, chain)
+        logger.info("Config reloaded: {:d} events added or changed, {:d} removed".format(len(changed), len(removed)))
+        await asyncio.to_thread(self._reconcile_indexes)
+
+    async def _config_task(self):
+        """ Task that reloads the config when the file is modified, or on SIGHUP """
+        period = self.config.get("config_check_period", CONFIG_CHECK_PERIOD)
+        mtime = os.stat(self.config_file).st_mtime
+        while True:
+            try:
+                await asyncio.wait_for(self._reload_requested.wait(), period or None)
+            except asyncio.TimeoutError:
+                pass
+            try:
+                new_mtime = os.stat(self.config_file).st_mtime
+            except OSError as e:
+                logger.error("Config file not readable: {!s}".format(e))
+                continue
+            if self._reload_requested.is_set() or new_mtime != mtime:
+                self._reload_requested.clear()
+                logger.info("Reloading config {}".format(self.config_file))
+                try:
+                    await self._reload_config()
+                except Exception as e: # pylint: disable=broad-except
+                    # The file is considered unchanged: the reload is retried at the next period
+                    logger.error("Error when reloading config: {!s}".format(e))
+                    continue
+                mtime = new_mtime
+
+    def _is_complete(self, coordinator, coll_name):
+        return all(map(coordinator.is_complete, self.store.events_of(coll_name)))
+
+    async def _build_indexes_task(self):
+        """ Task that builds the secondary indexes which were missing at startup """
+        for name in sorted(self._unbuilt_indexes):
+            try:
+                await asyncio.to_thread(self.indexes.reconcile, name)
+            except Exception as e: # pylint: disable=broad-except
+                logger.error("{} => Error when building indexes: {!s}".format(name, e))
+            self._unbuilt_indexes.discard(name)
+
+    async def _bulk_load_task(self):
+        """ Task that builds the deferred indexes when the events are completely indexed, and ends the bulk load mode """
+        while self._deferred_indexes:
+            await asyncio.sleep(BULK_LOAD_CHECK_PERIOD)
+            coordinator = await asyncio.to_thread(self._global_coordinator)
+            for name in [x for x in self._deferred_indexes if self._is_complete(coordinator, x)]:
+                logger.info("{} => History indexed: building secondary indexes".format(name))
+                try:
+                    await asyncio.to_thread(self.indexes.reconcile, name)
+                    self._deferred_indexes.discard(name)
+                except Exception as e: # pylint: disable=broad-except
+                    logger.error("{} => Error when building indexes: {!s}".format(name, e))
+        logger.info("Bulk load completed: all indexes built")
+
+    def _batched(self, live):
+        """ Return True when blocks are written without transaction, and checkpointed by batches """
+        return not live and self.profiles[False].checkpoint > 1
+
+    def _event_docs(self, blk, live=True):
+        """ Return the documents of the block events to be indexed """
+        docs = []
+        for e in blk.events():
+            if self.coordinator.should_index_event(e.chain, e.name, e.height):
+                doc = asdict(e)
+                if self.store.is_clustered(e.name):
+                    doc["_id"] = event_key(e.chain, e.height, e.rank)
+                elif self.idempotent or self._batched(live):
+                    doc["_id"] = e.uid
+                docs.append(doc)
+        return docs
+
+    def _insert_idempotent(self, coll_name, docs, write_concern):
+        try:
+            self.store.collection(coll_name, write_concern).insert_many(docs, ordered=False)
+        except BulkWriteError as e:
+            # Events already there come from a previous (interrupted) indexing of the same block
+            if any(err["code"] != DUPLICATE_KEY for err in e.details["writeErrors"]) or e.details.get("writeConcernErrors"):
+                raise
+
+    def _write_docs(self, chain, height, by_coll, live):
+        """ Write the events documents of a block, and mark it as indexed. Return the start and end times of the checkpoint """
+        profile = self.profiles[live]
+        if self.idempotent or self._batched(live):
+            # No transaction: the checkpoint may trail behind the data, re-indexing is harmless
+            for coll_name, ev_docs in by_coll.items():
+                self._insert_idempotent(coll_name, ev_docs, profile.write_concern)
+
+            # When batched, the checkpoint is the only durable marker. Being acknowledged with the
+            # durable profile, it also makes durable all the (relaxed) writes preceding it.
+            self._unchecked[chain] += 1
+            checkpoint = self._unchecked[chain] >= profile.checkpoint
+            if checkpoint:
+                self._unchecked[chain] = 0
+            validating = time.perf_counter()
+            self.coordinator.validate_block(chain, height, checkpoint=checkpoint)
+            return validating, time.perf_counter()
+
         with self.mongo_client.start_session() as session:
-            with session.start_transaction():
-                for e in blk.events():
-                    if self.coordinator.should_index_event(e.chain, e.name, e.height):
-                        self.db[e.name].insert_one(asdict(e), session=session)
-                self.coordinator.validate_block(blk.chain, blk.height, session=session)
+            with session.start_transaction(write_concern=profile.write_concern):
+                for coll_name, ev_docs in by_coll.items():
+                    self.store.collection(coll_name).insert_many(ev_docs, session=session)
+                validating = time.perf_counter()
+                self.coordinator.validate_block(chain, height, session=session)
+                validated = time.perf_counter()
+        return validating, validated
+
+    def _docs_by_collection(self, chain, height, docs):
+        """ Group the documents by collection. Filter them again: the block may have been indexed since its events were decoded """
+        by_coll = defaultdict(list)
+        for doc in docs:
+            if self.coordinator.should_index_event(chain, doc["name"], height):
+                by_coll[self.store.collection_name(doc["name"])].append(doc)
+        return by_coll
+
+    def _commit_docs(self, block, docs, log_height=0, live=True):
+        """ Write the events documents of a block (ChainWebBlock or BlockTrace) to the DB, and mark the block as indexed """
+        chain, height = block.chain, block.height
+        if not self._holds_block(chain, height, live):
+            # The lease has been lost since the block was queued: the block belongs to another instance now
+            self.stats["blocks_dropped"] += 1
+            return
+        start = time.perf_counter()
+        by_coll = self._docs_by_collection(chain, height, docs)
+        filtered = time.perf_counter()
+        validating, validated = self._write_docs(chain, height, by_coll, live)
+        end = time.perf_counter()
+        mode = "live" if live else "backfill"
+        events = sum(map(len, by_coll.values()))
+        self.commit_latency.observe(end - filtered, mode=mode)
+        self.stats["blocks_"+mode] += 1
+        self.stats["events_"+mode] += events
+
+        if self.tracer is not None and block.timings is not None:
+            # The transaction commit is accounted in the write stage
+            block.timings["filter"] = block.timings.get("filter", 0.0) + filtered - start
+            block.timings["checkpoint"] = validated - validating
+            block.timings["write"] = end - filtered - block.timings["checkpoint"]
+            self.tracer.record(block, live, events)
+
+        if log_height and height % log_height == 0:
+            logger.info("Chain {:<2}: Indexed block {:d}".format(chain, height))
+
+    def _filter_block(self, blk, live):
+        """ Return the documents of the block events to be indexed, timing the filter stage """
+        start = time.perf_counter()
+        docs = self._event_docs(blk, live)
+        blk.timings["filter"] = time.perf_counter() - start
+        return docs
+
+    def _index_block(self, blk, log_height=0, live=True):
+        self._commit_docs(blk, self._filter_block(blk, live), log_height, live)
 
-        if log_height and blk.height % log_height == 0:
-            logger.info("Chain {:<2}: Indexed block {:d}".format(blk.chain, blk.height))
+    def _commit_record(self, rec):
+        self._commit_docs(BlockTrace(rec["chain"], rec["height"], rec.get("timings"), rec.get("size", 0)), rec["events"], rec["log"], rec["live"])
+
+    def _checkpoint(self, chain):
+        self._unchecked[chain] = 0
+        self.coordinator.checkpoint(chain)
+
+    def _on_live_commit(self, chain, ts):
+        """ Measure the tip latency (block creation to commit), and open or close the backfill gate accordingly """
+        latency = time.time() - ts
+        self.tip_latency[chain] = latency
+        if latency > self.tip_latency_target:
+            now = time.monotonic()
+            if self._backfill_gate.is_set():
+                logger.warning("Chain {:<2}: Tip latency {:.1f}s => Throttling backfill".format(chain, latency))
+                self._throttle_deadline = now + THROTTLE_MAX_WAIT
+            elif now >= self._throttle_deadline + THROTTLE_RUN_PERIOD:
+                # Still late after a pause and a run period: pause again. Without live commits (ie: stalled stream), no new pause.
+                logger.info("Chain {:<2}: Tip latency still {:.1f}s => Pausing backfill again".format(chain, latency))
+                self._throttle_deadline = now + THROTTLE_MAX_WAIT
+            self._backfill_gate.clear()
+        elif not self._backfill_gate.is_set():
+            logger.info("Chain {:<2}: Tip latency {:.1f}s => Resuming backfill".format(chain, latency))
+            self._backfill_gate.set()
+
+    async def _throttle(self):
+        """ Wait while the live blocks are late. While they stay late, the backfill alternates pauses of THROTTLE_MAX_WAIT
+            and runs of THROTTLE_RUN_PERIOD """
+        timeout = self._throttle_deadline - time.monotonic()
+        if not self._backfill_gate.is_set() and timeout > 0:
+            try:
+                await asyncio.wait_for(self._backfill_gate.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    def _on_block_committed(self, blk, live, fut):
+        self.coordinator.clear_pending(blk.chain, blk.height)
+        if live and not fut.cancelled() and fut.exception() is None:
+            self._on_live_commit(blk.chain, blk.ts.timestamp())
+
+    async def _submit_block(self, blk, log_height=0, live=True):
+        """ Queue a block to the writer (or to the spool), and return the future of its commit """
+        if not live:
+            await self._throttle()
+        self.coordinator.set_pending(blk.chain, blk.height)
+        if self.spool is not None:
+            rec = {"chain":blk.chain, "height":blk.height, "log":log_height, "live":live, "ts":blk.ts.timestamp(),
+                   "events":self._filter_block(blk, live)}
+            if self.tracer is not None:
+                rec.update(timings=blk.timings, size=blk.size)
+            await self.spool.append(rec)
+            return None
+
+        try:
+            fut = await self.writer.submit(self._index_block, blk, log_height, live, live=live)
+        except BaseException:
+            # Cancelled while the queue was full (ie: fill task stopped): the block is not in flight
+            self.coordinator.clear_pending(blk.chain, blk.height)
+            raise
+        fut.add_done_callback(partial(self._on_block_committed, blk, live))
+        return fut
+
+    def _ack_record(self, position):
+        # Live records overtake the backfill ones: only the contiguous prefix of committed records can be acknowledged
+        self._spool_inflight[position] = True
+        acked = None
+        while self._spool_inflight and next(iter(self._spool_inflight.values())):
+            acked, _ = self._spool_inflight.popitem(last=False)
+        if acked is not None:
+            self.spool.ack(acked)
+
+    def _on_record_drained(self, position, rec, fut):
+        if fut.cancelled() or fut.exception() is not None:
+            # Only the first failure of a drain cycle may be due to the record: the next records fail behind it.
+            # Neither is a DB unreachable (network, election): it says nothing about the record.
+            if not self._spool_failed.is_set() and not fut.cancelled() and not db_unavailable(fut.exception()):
+                self._spool_attempts[position] += 1
+            self._spool_failed.set()
+            return
+        if self._spool_failed.is_set():
+            return
+        self._spool_attempts.pop(position, None)
+        self.coordinator.clear_pending(rec["chain"], rec["height"])
+        if rec["live"] and "ts" in rec:
+            self._on_live_commit(rec["chain"], rec["ts"])
+        self._ack_record(position)
+
+    async def _feed_spool(self, futs):
+        """ Submit the spooled records to the writer """
+        async for position, rec in self.spool.read():
+            self._spool_inflight[position] = False
+            if self._spool_attempts[position] >= SPOOL_MAX_ATTEMPTS:
+                # Poison record: set aside. Its block is missing again, and will be fetched by the history indexing
+                logger.error("Chain {:<2}: Spooled block {:d} failed {:d} times: moved to quarantine".format(rec["chain"], rec["height"],
+                                                                                                          SPOOL_MAX_ATTEMPTS))
+                self.spool.quarantine(rec)
+                del self._spool_attempts[position]
+                self.coordinator.clear_pending(rec["chain"], rec["height"])
+                self._ack_record(position)
+                continue
+            fut = await self.writer.submit(self._commit_record, rec, live=rec["live"])
+            fut.add_done_callback(partial(self._on_record_drained, position, rec))
+            futs.add(fut)
+            fut.add_done_callback(futs.discard)
+
+    async def _drain_spool(self):
+        """ Task that writes the spooled blocks to the DB (live blocks first) """
+        while True:
+            self._spool_failed.clear()
+            self._spool_inflight.clear()
+            futs = set()
+            feeder = asyncio.create_task(self._feed_spool(futs))
+            try:
+                # Failures are noticed at once, even when no new record comes
+                await self._spool_failed.wait()
+            finally:
+                feeder.cancel()
+
+            # A write has failed: wait for the in-flight records, and restart after the last acknowledged one
+            if futs:
+                await asyncio.wait(list(futs))
+            logger.warning("Spool: DB write failed, retrying")
+            await asyncio.sleep(SPOOL_RETRY_DELAY)
+
+    async def _fill_hole(self, cw, ref_blk, lower, upper, anchor=None):
+        chain = ref_blk.chain
+        # Start from the closest known block above the hole: the given anchor, the cursor left by the previous run,
+        # or the tip
+        anchor_height, anchor = min(filter(None, [anchor, self.coordinator.cursor(chain, upper), (ref_blk.height, ref_blk.block_hash)]))
+        logger.info("Chain {:<2}: Fill hole {:d} -> {:d} (from block {:d})".format(chain, lower, upper, anchor_height))
+        fut = None
+        async for b in self.decoder.decode(cw.get_blocks(chain, anchor, lower, upper)):
+            self._cursors[chain][lower] = (b.height, b.block_hash)
+            # Holes may have been merged (see plan_fills): the blocks between them are already indexed
+            if not self.coordinator.wanted_events(chain, b.height):
+                self.stats["blocks_discarded"] += 1
+                continue
+            fut = await self._submit_block(b, 1000, live=False)
+        # Blocks are committed in order: when the last one is done, the hole is filled
+        if fut is not None:
+            await fut
+        await (await self.writer.submit(self._checkpoint, chain, live=False))
+        self._cursors[chain].pop(lower, None)
+        logger.info("Chain {:<2}: Fill hole completed {:d} -> {:d}".format(chain, lower, upper))
+
+    async def _load_anchors(self, cw, ref_blk, heights):
+        """ Yield the anchors (height, hash) of a chain at the given heights, as soon as they are known.
+            The unknown ones are fetched from the headers (from the top), and recorded one by one """
+        chain = ref_blk.chain
+        anchors = await asyncio.to_thread(self.anchors.get, chain, heights)
+        for height, block_hash in sorted(anchors.items(), reverse=True):
+            yield height, block_hash
+        missing = sorted(set(heights) - anchors.keys())
+        if not missing:
+            return
+        logger.info("Chain {:<2}: Fetching anchors {:d} -> {:d}".format(chain, missing[0], missing[-1]))
+        _, parent = min(filter(None, [self.coordinator.cursor(chain, missing[-1]), (ref_blk.height, ref_blk.block_hash)]))
+        wanted = set(missing)
+        async for x in cw.get_headers(chain, parent, missing[0], missing[-1]):
+            if x.height in wanted:
+                # Recorded at once: an interrupted walk doesn't have to be done again
+                await asyncio.to_thread(self.anchors.add, chain, {x.height:x.block_hash})
+                yield x.height, x.block_hash
+
+    async def _sub_ranges(self, cw, ref_blk, lower, heights):
+        """ Yield the sub-range below each anchor ([previous anchor, anchor-1]) with its anchor, as soon as the anchor is known:
+            (lower, upper, anchor) """
+        sub_lowers = dict(zip(heights, [lower] + heights))
+        found = set()
+        async for height, block_hash in self._load_anchors(cw, ref_blk, heights):
+            found.add(height)
+            yield sub_lowers[height], height-1, (height, block_hash)
+        # Anchors not returned by the node: these sub-ranges start from the cursor or the tip
+        for height in heights:
+            if height not in found:
+                yield sub_lowers[height], height-1, None
+
+    async def _fill_range(self, cw, ref_blk, lower, upper):
+        """ Fill a range of blocks. A large range is split on the anchors, and the sub-ranges are filled concurrently,
+            each one starting as soon as the anchor above it is known """
+        heights = self.anchors.heights(lower, min(upper, ref_blk.height - ANCHOR_MIN_DEPTH))
+        if self.fill_parallelism <= 1 or not heights:
+            await self._fill_hole(cw, ref_blk, lower, upper)
+            return
+
+        sem = asyncio.Semaphore(self.fill_parallelism)
+        async def fill(sub_lower, sub_upper, anchor=None):
+            async with sem:
+                await self._fill_hole(cw, ref_blk, sub_lower, sub_upper, anchor)
+
+        # The top sub-range starts from the cursor or the tip
+        tasks = [asyncio.create_task(fill(heights[-1], upper))]
+        try:
+            async for sub_range in self._sub_ranges(cw, ref_blk, lower, heights):
+                tasks.append(asyncio.create_task(fill(*sub_range)))
+        except asyncio.CancelledError:
+            for task in tasks:
+                task.cancel()
+            raise
+        finally:
+            results = await asyncio.gather(*tasks, return_exceptions=True)
+        for res in results:
+            if isinstance(res, BaseException):
+                raise res
+
+    async def _fill_leased_hole(self, cw, ref_blk, hole):
+        """ Fill a hole segment by segment, each segment being protected by a lease """
+        chain = ref_blk.chain
+        for segment, lower, upper in split_segments(hole.lower, hole.upper, self.lease_span):
+            key = range_lease(chain, segment)
+            if not await asyncio.to_thread(self.leases.acquire, key):
+                continue
+            try:
+                # The segment may have been (partially) filled by another instance
+                await (await self.writer.submit(self.coordinator.reload, chain))
+                for fill_lower, fill_upper in plan_fills(self.coordinator.get_missing(chain, upper) & P.closed(lower, upper)):
+                    await self._fill_range(cw, ref_blk, fill_lower, fill_upper)
+            finally:
+                await asyncio.to_thread(self.leases.release, key)
 
     async def _fill_missing_blocks(self, cw, ref_blk):
-        for it in reversed(self.coordinator.get_missing(ref_blk.chain, ref_blk.height-1)):
-            logger.info("Chain {:<2}: Fill hole {:d} -> {:d}".format(ref_blk.chain, it.lower, it.upper))
-            async for b in cw.get_blocks(ref_blk.chain, ref_blk.block_hash, it.lower, it.upper):
-                self._index_block(b,1000)
-            logger.info("Chain {:<2}: Fill hole completed {:d} -> {:d}".format(ref_blk.chain, it.lower, it.upper))
+        if self.leases is None:
+            for lower, upper in plan_fills(self.coordinator.get_missing(ref_blk.chain, ref_blk.height-1)):
+                await self._fill_range(cw, ref_blk, lower, upper)
+            return
+
+        max_height = ref_blk.height - (1 if self._indexes_live(ref_blk.chain) else LIVE_MARGIN)
+        for it in reversed(self.coordinator.get_missing(ref_blk.chain, max_height)):
+            await self._fill_leased_hole(cw, ref_blk, it)
+
+    async def _leases_task(self):
+        """ Heartbeat: renew the held leases, and try to take the leases of the chains (takeover of expired ones) """
+        while True:
+            try:
+                self._on_leases_lost(await asyncio.to_thread(self.leases.renew))
+                for chain in self._configured_chains():
+                    key = chain_lease(chain)
+                    if not self.leases.holds(key) and await asyncio.to_thread(self.leases.acquire, key):
+                        # Another instance may have indexed this chain until now
+                        await (await self.writer.submit(self.coordinator.reload, chain))
+                        # The blocks close to the tip are now filled by this instance
+                        self._wake_fill_task(chain)
+            except Exception as e: # pylint: disable=broad-except
+                logger.error("Error when handling leases: {!s}".format(e))
+            await asyncio.sleep(self.leases.ttl.total_seconds() / 3)
+
+    def _on_leases_lost(self, lost):
+        """ Stop working on the chains whose leases have been lost. Their queued blocks are dropped by the writer (see _holds_block) """
+        for chain in sorted({lease_chain(key) for key in lost}, key=int):
+            task = self._fill_tasks.pop(chain, None)
+            if task is not None:
+                # Restarted with the next block of the chain (or cut refresh), with the leases still held
+                logger.warning("Chain {:<2}: Lease lost => Restarting history indexing".format(chain))
+                task.cancel()
+
+    def _wake_fill_task(self, chain):
+        self._wakeups[chain].set()
 
     async def _fill_missing_blocks_task(self, cw, chain):
+        wakeup = self._wakeups[chain]
+        # With leases, the holes left by the other instances (released or expired leases) are not notified
+        idle_period = FILL_IDLE_PERIOD if self.leases is None else min(FILL_IDLE_PERIOD, self.leases.ttl.total_seconds())
         while True:
             try:
-                # Fill missing blocks
+                wakeup.clear()
                 await self._fill_missing_blocks(cw, self._tips[chain])
-                
-                # Run scripts after filling missing blocks
-                #logger.info("Running scripts after filling missing blocks")
-                
-                # Sleep before the next iteration
-                await asyncio.sleep(5.0)
+
+                # Wait for new missing blocks
+                try:
+                    await asyncio.wait_for(wakeup.wait(), idle_period)
+                except asyncio.TimeoutError:
+                    pass
             except asyncio.CancelledError:
                 logger.info("Chain {:<2}: => Ended".format(chain))
                 return
             except Exception as e:  # pylint: disable=broad-except
                 logger.error("Chain {:<2}: Error when filling blocks: {!s}".format(chain, e))
-                await asyncio.sleep(5.0)  
+                await asyncio.sleep(5.0)
+
+    def _start_fill_task(self, cw, chain):
+        if chain not in self._fill_tasks:
+            self._fill_tasks[chain] = asyncio.create_task(self._fill_missing_blocks_task(cw, chain))
+
+    async def _update_tips(self, cw):
+        """ Anchor the fill tasks on the current cut of the node, unless the stream has already brought newer blocks """
+        cut = await cw.get_cut()
+        for chain, ref in cut.items():
+            if not self._owns(chain):
+                continue
+            if chain not in self._tips or self._tips[chain].height < ref.height:
+                self._tips[chain] = ref
+                self.coordinator.set_tip(chain, ref.height)
+            self._start_fill_task(cw, chain)
+
+    async def _cut_task(self, cw):
+        """ Task that periodically refreshes the tips from the cut of the node, independently of the block stream """
+        while True:
+            try:
+                await self._update_tips(cw)
+            except Exception as e: # pylint: disable=broad-except
+                logger.error("Error when getting the cut: {!s}".format(e))
+            await asyncio.sleep(CUT_REFRESH_PERIOD)
+
+    def _indexed_height(self, chain):
+        """ Return the highest indexed block of a chain """
+        return max((done.upper for done in self.coordinator.done[chain].values() if not done.empty), default=0)
+
+    def _missing_blocks(self):
+        for chain in self._configured_chains():
+            if chain not in self._tips:
+                continue
+            for name, wanted in self.coordinator.wanted[chain].items():
+                missing = (wanted - self.coordinator.done[chain][name]) & P.closed(MIN_HEIGHT, self._tips[chain].height)
+                yield {"chain":chain, "event":name}, sum(it.upper - it.lower + 1 for it in missing)
+
+    def _collect_metrics(self):
+        """ Metrics computed at each scrape (see MetricsServer) """
+        chains = self._configured_chains()
+        yield ("kadena_indexer_tip_height", "gauge", "Height of the last known block of the chain",
+               [({"chain":c}, self._tips[c].height) for c in chains if c in self._tips])
+        yield ("kadena_indexer_indexed_height", "gauge", "Height of the highest indexed block of the chain",
+               [({"chain":c}, self._indexed_height(c)) for c in chains])
+        yield ("kadena_indexer_lag_seconds", "gauge", "Delay between the creation of the last live block and its commit",
+               [({"chain":c}, round(x, 3)) for c, x in sorted(self.tip_latency.items())])
+        yield ("kadena_indexer_missing_blocks", "gauge", "Blocks remaining to be indexed up to the tip, by chain and event",
+               list(self._missing_blocks()))
+        if self.writer is not None:
+            yield ("kadena_indexer_write_queue_depth", "gauge", "Blocks waiting to be written",
+                   [({"queue":"live"}, self.writer.queue_depth(True)), ({"queue":"backfill"}, self.writer.queue_depth(False))])
+
+        # Counters: the live/backfill ones are labelled by mode
+        counters = defaultdict(list)
+        for key, value in sorted(self.stats.items()):
+            base, _, mode = key.rpartition("_")
+            if mode in ("live", "backfill"):
+                counters[base].append(({"mode":mode}, value))
+            else:
+                counters[key].append(({}, value))
+        for key, samples in counters.items():
+            yield "kadena_indexer_{}_total".format(key), "counter", key.replace("_", " ").capitalize(), samples
+
+    def _toggle_profiling(self):
+        """ SIGUSR1 handler: start or stop a profiling session """
+        if self._profiling_task is None or self._profiling_task.done():
+            self._profiling_task = asyncio.create_task(self.profiler.toggle(self.writer))
+
+    async def _handle_profile_start(self, _request):
+        started = await self.profiler.start(self.writer)
+        return web.json_response({"profiling":True, "started":started})
+
+    async def _handle_profile_stop(self, _request):
+        path = await self.profiler.stop(self.writer)
+        return web.json_response({"profiling":False, "report":path})
+
+    def _metrics_server(self):
+        """ Return the metrics server (an async context manager), or a null context when disabled """
+        cfg = self.config.get("metrics")
+        if not cfg:
+            return nullcontext()
+        # Each indexer process (see Supervisor) has its own port
+        server = MetricsServer(cfg.get("host", "0.0.0.0"), cfg.get("port", METRICS_PORT) + self.worker_id)
+        server.add_collector(self._collect_metrics)
+        server.add_histogram(self.node_latency)
+        server.add_histogram(self.commit_latency)
+        # The metrics endpoint is not authenticated: the profiling routes must be enabled explicitly
+        if cfg.get("profiling"):
+            server.add_route("POST", "/profile/start", self._handle_profile_start)
+            server.add_route("POST", "/profile/stop", self._handle_profile_stop)
+        return server
+
+    async def _stats_task(self):
+        """ Task that periodically reports the indexer counters to the supervisor """
+        while True:
+            await asyncio.sleep(STATS_PERIOD)
+            self._stats_queue.put((self.chains, dict(self.stats)))
+
+    def _save_cursors(self):
+        for chain in self._configured_chains():
+            cursors = dict(self.coordinator.cursors[chain])
+            cursors.update(self._cursors[chain].values())
+            self.coordinator.save_cursors(chain, cursors)
+
+    async def _shutdown(self, fill_tasks):
+        """ Orderly shutdown: stop the fill tasks, commit the queued blocks, checkpoint, and persist the fill cursors """
+        logger.info("Stopping: committing the queued blocks")
+        for tsk in fill_tasks:
+            tsk.cancel()
+        await asyncio.gather(*fill_tasks, return_exceptions=True)
+        # Jobs are executed in order: these ones run after all the queued blocks
+        for chain in self._configured_chains():
+            await (await self.writer.submit(self._checkpoint, chain, live=False))
+        await (await self.writer.submit(self._save_cursors, live=False))
+        if self.profiler.active:
+            await self.profiler.stop(self.writer)
+        logger.info("Stopped: final checkpoint written")
+
+    def _start_tasks(self, cw):
+        """ Start the tasks running along the block stream: {name:task} """
+        if self.spool is not None:
+            # Spooled blocks first: they come before the new ones
+            drainer = asyncio.create_task(self._drain_spool())
+        self._prune_db()
+        coros = {"pruning":self.pruner.run(), "build_indexes":self._build_indexes_task(), "config_watch":self._config_task(),
+                 # The history indexing starts right now, from the cut: not after the first streamed blocks
+                 "cut_refresh":self._cut_task(cw)}
+        if self.bulk_load:
+            coros["bulk_load"] = self._bulk_load_task()
+        if self._stats_queue is not None:
+            coros["stats"] = self._stats_task()
+        if self.leases is not None:
+            coros["leases"] = self._leases_task()
+        tasks = {name:asyncio.create_task(coro) for name, coro in coros.items()}
+        if self.spool is not None:
+            tasks["drainer"] = drainer
+        return tasks
+
+    async def _stop_tasks(self, tasks):
+        """ Stop the tasks started by _start_tasks, and shut down. The leases are kept until the final checkpoint is written """
+        leases = tasks.pop("leases", None)
+        # Not drained blocks stay in the spool: they will be replayed at the next start
+        for task in tasks.values():
+            task.cancel()
+        try:
+            await self._shutdown(list(self._fill_tasks.values()))
+        except Exception as e: # pylint: disable=broad-except
+            logger.error("Error when stopping: {!s}".format(e))
+        if leases is not None:
+            leases.cancel()
+            await asyncio.to_thread(self.leases.release_all)
 
     async def run(self):
         """ Async function to start the indexer """
-        task_started = {}
-        async with ChainWeb(self.config.node) as cw:
+        self._fill_tasks = {}
+        self._backfill_gate = asyncio.Event()
+        self._backfill_gate.set()
+        loop = asyncio.get_running_loop()
+        loop.add_signal_handler(signal.SIGTERM, asyncio.current_task().cancel)
+        self._reload_requested = asyncio.Event()
+        loop.add_signal_handler(signal.SIGHUP, self._reload_requested.set)
+        self.coordinator.add_listener(partial(loop.call_soon_threadsafe, self._wake_fill_task))
+        stream = StreamOptions(self.config.get("fallback_nodes"), self.config.get("stall_timeout", STALL_TIMEOUT), self.headers_only)
+        async with ChainWeb(self.config.node, stream, self.stats, self.node_latency) as cw, Writer(self.config.get("write_queue", WRITE_QUEUE_SIZE)) as self.writer, \
+                   self._metrics_server():
             logger.info("Start listening CW node")
+            # The profiling sessions include the writer thread: only once it exists
+            loop.add_signal_handler(signal.SIGUSR1, self._toggle_profiling)
+            tasks = self._start_tasks(cw)
             try:
-                async for b in cw.get_new_block():
-                    self._index_block(b, 200)
+                async for b in cw.get_new_block(self._repairs_gaps, self._wants_payload if self.headers_only else None):
+                    if not self._owns(b.chain):
+                        continue
+                    # A block whose payload is missing (but needed) is left to the history indexing
+                    if self._indexes_live(b.chain) and (b.has_payload or not self.coordinator.wanted_events(b.chain, b.height)):
+                        await self._submit_block(await self.decoder.decode_one(b), 200)
                     self._tips[b.chain] = b
-                    if b.chain not in task_started:
-                        task_started[b.chain] = asyncio.create_task(self._fill_missing_blocks_task(cw, b.chain))
-                    
+                    self.coordinator.set_tip(b.chain, b.height)
+                    self._start_fill_task(cw, b.chain)
+
             except asyncio.CancelledError:
                 logger.info("Cancelled")
-                for tsk in task_started.values():
-                    tsk.cancel()
-                    #await tsk
             except Exception as e:
                 logger.error("Error in run method: {!s}".format(e))
-       
-        
+            loop.remove_signal_handler(signal.SIGTERM)
+            loop.remove_signal_handler(signal.SIGHUP)
+            loop.remove_signal_handler(signal.SIGUSR1)
+            await self._stop_tasks(tasks)
+
+        self.decoder.close()
+        if self.spool is not None:
+            self.spool.close()
+        if self.tracer is not None:
+            self.tracer.close()
@@ -0,0 +1,96 @@
+import logging
+from datetime import datetime, timedelta, UTC
+
+from pymongo import IndexModel, ASCENDING
+
+logger = logging.getLogger(__name__)
+
+# Standard indexes, not needed by the indexer itself
+SECONDARY_FIELDS = ["reqKey", "height", "block", "ts"]
+
+# Indexes whose name starts with these prefixes are managed by the indexer. Others belong to the user.
+MANAGED_PREFIXES = ("st_", "cf_")
+
+# The usage counters of the indexes are reset when MongoDB restarts (or when the index is built): shorter stats are not reported
+UNUSED_MIN_PERIOD = timedelta(days=7)
+
+def index_model(decl, prefix=()):
+    """ Build an index (with its keys prefixed) from a config declaration:
+         - a list of fields (ascending order), ie: [params.0, height]
+         - or a mapping with keys (field => direction) and an optional name, ie: {keys: {params.1: 1, height: -1}, name: by_receiver} """
+    if isinstance(decl, (list, tuple)):
+        keys = [(field, ASCENDING) for field in decl]
+        name = None
+    else:
+        keys = list(decl["keys"].items())
+        name = decl.get("name")
+    return IndexModel(list(prefix) + keys, name=name or "cf_" + "_".join("{}_{}".format(*k) for k in keys))
+
+def _keys(idx):
+    return list(idx.document["key"].items())
+
+
+class IndexManager:
+    """ Reconcile the indexes declared in the config with the existing ones """
+    def __init__(self, store, drop_stale=False):
+        self.store = store
+        self.db = store.db
+        self.drop_stale = drop_stale
+        self.declared = {}
+
+    def declare(self, events):
+        """ Declare the indexes of the events (standard indexes + the ones from the config) in their collections: {name:declarations}.
+            The previous declarations are replaced at once (config reload) """
+        prefix = self.store.key_prefix()
+        declared = {}
+        for name, declarations in events.items():
+            indexes = declared.setdefault(self.store.collection_name(name),
+                                          {"st_"+field:IndexModel(prefix+[(field, ASCENDING)], name="st_"+field) for field in SECONDARY_FIELDS})
+            for decl in declarations or []:
+                idx = index_model(decl, prefix)
+                indexes[idx.document["name"]] = idx
+        self.declared = declared
+
+    def _create(self, name, indexes):
+        """ Create the missing indexes of an event collection, in one pass """
+        current_idx = self.db[name].index_information()
+        missing = [idx for idx in indexes if idx.document["name"] not in current_idx]
+        for idx in missing:
+            logger.warning("{} => Index {} missing".format(name, idx.document["name"]))
+        if missing:
+            self.db[name].create_indexes(missing)
+
+    def reconcile(self, name, deferred=False):
+        """ Build the missing indexes of an events collection, report the unused ones and handle the stale ones.
+            When deferred, only the indexes required by the indexer are built """
+        if name not in self.declared:
+            # Not an events collection anymore (events removed from the config)
+            return
+        required = {idx.document["name"]:idx for idx in self.store.required_indexes(name)}
+        if deferred:
+            self._create(name, required.values())
+            return
+
+        declared = dict(self.declared[name], **required)
+        coll = self.db[name]
+        for idx_name, info in coll.index_information().items():
+            if not idx_name.startswith(MANAGED_PREFIXES):
+                continue
+            if idx_name not in declared or list(info["key"]) != _keys(declared[idx_name]):
+                if self.drop_stale:
+                    logger.warning("{} => Dropping stale index {}".format(name, idx_name))
+                    coll.drop_index(idx_name)
+                else:
+                    logger.warning("{} => Stale index {} (enable drop_stale_indexes to drop it)".format(name, idx_name))
+
+        self._create(name, declared.values())
+        self._report_unused(name)
+
+    def _report_unused(self, name):
+        now = datetime.now(UTC)
+        for stats in self.db[name].aggregate([{"$indexStats":{}}]):
+            since = stats["accesses"]["since"]
+            if since.tzinfo is None:
+                since = since.replace(tzinfo=UTC)
+            if stats["name"] != "_id_" and not stats["accesses"]["ops"] and now - since >= UNUSED_MIN_PERIOD:
+                logger.info("{} => Index {} unused since {!s}".format(name, stats["name"], stats["accesses"]["since"]))
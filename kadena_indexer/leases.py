@@ -0,0 +1,87 @@
+import logging
+import os
+import socket
+from datetime import datetime, timedelta, UTC
+
+from pymongo.errors import DuplicateKeyError
+
+logger = logging.getLogger(__name__)
+
+LEASE_TTL = 30.0
+LEASE_SPAN = 1000000
+
+# Instances not holding the lease of a chain don't fill the holes that close to the tip: they belong to the live indexer
+LIVE_MARGIN = 100
+
+def chain_lease(chain):
+    """ Key of the lease for indexing the live blocks of a chain """
+    return "lease:chain:{}".format(chain)
+
+def range_lease(chain, segment):
+    """ Key of the lease for filling a segment of LEASE_SPAN blocks of a chain """
+    return "lease:fill:{}:{:d}".format(chain, segment)
+
+def lease_chain(key):
+    """ Return the chain of a lease key """
+    return key.split(":")[2]
+
+def split_segments(lower, upper, span):
+    """ Split a range of heights on the span boundaries, from the top: yield (segment, lower, upper) """
+    while upper >= lower:
+        seg_lower = max(lower, upper - upper % span)
+        yield upper // span, seg_lower, upper
+        upper = seg_lower - 1
+
+
+class Leases:
+    """ Leases stored in the coordinator collection, allowing several indexer instances to share the work """
+
+    # A lease is a document {_id:key, owner, expires}. It can be taken when it doesn't exist, or has expired.
+    # The held leases have to be renewed (heartbeat) before ttl.
+    def __init__(self, collection, owner=None, ttl=LEASE_TTL):
+        self.collection = collection
+        self.owner = owner or "{}:{:d}".format(socket.gethostname(), os.getpid())
+        self.ttl = timedelta(seconds=ttl)
+        self.held = set()
+
+    def acquire(self, key):
+        """ Try to take (or renew) a lease. Return true on success """
+        now = datetime.now(UTC)
+        try:
+            self.collection.update_one({"_id":key, "$or":[{"owner":self.owner}, {"expires":{"$lt":now}}]},
+                                       {"$set":{"owner":self.owner, "expires":now+self.ttl}}, upsert=True)
+        except DuplicateKeyError:
+            # Held by another instance
+            return False
+        if key not in self.held:
+            logger.info("Lease {} acquired by {}".format(key, self.owner))
+            self.held.add(key)
+        return True
+
+    def release(self, key):
+        """ Release a lease """
+        self.held.discard(key)
+        self.collection.delete_one({"_id":key, "owner":self.owner})
+
+    def holds(self, key):
+        """ Return true if the lease is currently held """
+        return key in self.held
+
+    def renew(self):
+        """ Heartbeat: renew all the held leases. Return the leases that have been lost """
+        if not self.held:
+            return set()
+        now = datetime.now(UTC)
+        keys = list(self.held)
+        self.collection.update_many({"_id":{"$in":keys}, "owner":self.owner}, {"$set":{"expires":now+self.ttl}})
+        still_held = {x["_id"] for x in self.collection.find({"_id":{"$in":keys}, "owner":self.owner}, {"_id":1})}
+        lost = self.held - still_held
+        for key in lost:
+            logger.warning("Lease {} lost".format(key))
+        self.held &= still_held
+        return lost
+
+    def release_all(self):
+        """ Release all the held leases """
+        for key in list(self.held):
+            self.release(key)
@@ -0,0 +1,119 @@
+import logging
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+from aiohttp import web
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(k, str(v).replace("\\", "\\\\").replace('"', '\\"')) for k, v in labels.items()) + "}"
+
+def render_metric(name, kind, help_text, samples):
+    """ Render a metric in the Prometheus text format. samples: iterable of (labels, value) """
+    lines = ["# HELP {} {}".format(name, help_text), "# TYPE {} {}".format(name, kind)]
+    lines.extend("{}{} {}".format(name, _format_labels(labels), value) for labels, value in samples)
+    return lines
+
+
+class Histogram:
+    """ Prometheus histogram, with labels. Can be observed from any thread """
+    def __init__(self, name, help_text, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = tuple(buckets)
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        """ Record an observation """
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            # Per bucket counts (the last one is +Inf), sum
+            series = self._series.setdefault(key, [[0]*(len(self.buckets)+1), 0.0])
+            series[0][bisect_left(self.buckets, value)] += 1
+            series[1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        """ Context manager observing its duration """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def render(self):
+        """ Render the histogram in the Prometheus text format """
+        lines = ["# HELP {} {}".format(self.name, self.help_text), "# TYPE {} histogram".format(self.name)]
+        with self._lock:
+            series = [(dict(key), list(counts), total) for key, (counts, total) in self._series.items()]
+        for labels, counts, total in series:
+            cumulated = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                cumulated += count
+                lines.append("{}_bucket{} {}".format(self.name, _format_labels(dict(labels, le=bound)), cumulated))
+            lines.append("{}_sum{} {}".format(self.name, _format_labels(labels), total))
+            lines.append("{}_count{} {}".format(self.name, _format_labels(labels), cumulated))
+        return lines
+
+
+class MetricsServer:
+    """ HTTP server exposing the metrics in the Prometheus text format on /metrics """
+
+    # The histograms are updated when observed. The other metrics are computed at each scrape by the collectors:
+    # callables returning an iterable of (name, kind, help, samples).
+    def __init__(self, host="0.0.0.0", port=9100):
+        self.host = host
+        self.port = port
+        self.histograms = []
+        self.collectors = []
+        self._app = web.Application()
+        self._app.router.add_get("/metrics", self._handle_metrics)
+        self._runner = None
+
+    def add_histogram(self, histogram):
+        """ Expose a histogram """
+        self.histograms.append(histogram)
+        return histogram
+
+    def add_collector(self, collector):
+        """ Expose the metrics returned by a collector """
+        self.collectors.append(collector)
+
+    def add_route(self, method, path, handler):
+        """ Add another endpoint to the server """
+        self._app.router.add_route(method, path, handler)
+
+    def render(self):
+        """ Render all the metrics """
+        lines = []
+        for collector in self.collectors:
+            try:
+                for name, kind, help_text, samples in collector():
+                    lines.extend(render_metric(name, kind, help_text, samples))
+            except Exception as e: # pylint: disable=broad-except
+                logger.error("Error when collecting metrics: {!s}".format(e))
+        for histogram in self.histograms:
+            lines.extend(histogram.render())
+        return "\n".join(lines) + "\n"
+
+    async def _handle_metrics(self, _request):
+        return web.Response(body=self.render().encode(), headers={"Content-Type":CONTENT_TYPE})
+
+    async def __aenter__(self):
+        self._runner = web.AppRunner(self._app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.host, self.port).start()
+        logger.info("Metrics available on http://{}:{:d}/metrics".format(self.host, self.port))
+        return self
+
+    async def __aexit__(self, *args):
+        await self._runner.cleanup()
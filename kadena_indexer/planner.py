@@ -0,0 +1,23 @@
+import math
+
+from .chainweb import BLOCKS_PER_REQUEST
+
+# Estimated cost (in requests) of a branch traversal setup, in addition to its pages
+TRAVERSAL_COST = 1
+
+def fetch_cost(size, per_request=BLOCKS_PER_REQUEST):
+    """ Estimated cost (in requests) of fetching a range of blocks with one branch traversal """
+    return TRAVERSAL_COST + math.ceil(size / per_request)
+
+def plan_fills(missing, per_request=BLOCKS_PER_REQUEST):
+    """ Group the missing intervals into (lower, upper) ranges to be fetched by one branch traversal each, from the top.
+        Neighbour holes are merged when fetching the (already indexed) blocks between them is cheaper than another traversal """
+    plan = []
+    for it in reversed(missing):
+        if plan:
+            lower, upper = plan[-1]
+            if fetch_cost(upper - it.lower + 1, per_request) <= fetch_cost(upper - lower + 1, per_request) + fetch_cost(it.upper - it.lower + 1, per_request):
+                plan[-1] = (it.lower, upper)
+                continue
+        plan.append((it.lower, it.upper))
+    return plan
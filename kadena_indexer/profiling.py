@@ -0,0 +1,115 @@
+import asyncio
+import cProfile
+import io
+import logging
+import os
+import pstats
+import sys
+from collections import Counter
+from datetime import datetime, UTC
+
+logger = logging.getLogger(__name__)
+
+PROFILE_TOP = 50
+
+# Since Python 3.12, cProfile relies on sys.monitoring: a profiler sees all the threads, and only one can be enabled at a time
+PROCESS_WIDE = sys.version_info >= (3, 12)
+
+# Entry points of the stages of a block (see tracing): (file, function)
+STAGE_FUNCTIONS = {
+    "fetch":[("chainweb.py", "get_blocks"), ("chainweb.py", "get_payloads")],
+    "parse":[("chainweb.py", "_parse_block_stream")],
+    "decode":[("chainweb.py", "decode_events")],
+    "filter":[("indexer.py", "_event_docs")],
+    "write":[("indexer.py", "_write_docs")],
+    "checkpoint":[("coordinator.py", "validate_block"), ("coordinator.py", "checkpoint")],
+}
+
+def stage_times(stats):
+    """ Return the cumulative time of each stage from pstats.Stats """
+    entries = {entry:stage for stage, funcs in STAGE_FUNCTIONS.items() for entry in funcs}
+    result = Counter()
+    for (filename, _, func), (_, _, _, cumtime, _) in stats.stats.items():
+        stage = entries.get((os.path.basename(filename), func))
+        if stage is not None:
+            result[stage] += cumtime
+    return result
+
+
+class Profiler:
+    """ On demand cProfile sessions of the event loop thread and of the writer thread """
+
+    # Nothing is profiled between sessions: no overhead. The decoding processes (see Decoder) are not profiled.
+    def __init__(self, directory="."):
+        self.directory = directory
+        self._profiles = None
+        self._started = None
+        # Start and stop may be requested concurrently (signal, HTTP)
+        self._lock = asyncio.Lock()
+
+    @property
+    def active(self):
+        """ Return true when a session is running """
+        return self._profiles is not None
+
+    async def start(self, writer):
+        """ Start a session. Return False if a session is already running """
+        async with self._lock:
+            if self.active:
+                return False
+            self._started = datetime.now(UTC)
+            profiles = [cProfile.Profile()]
+            profiles[0].enable()
+            if not PROCESS_WIDE:
+                # Before Python 3.12, cProfile only profiles the thread it has been enabled from
+                profiles.append(cProfile.Profile())
+                try:
+                    await (await writer.submit(profiles[1].enable))
+                except BaseException:
+                    profiles[0].disable()
+                    raise
+            self._profiles = profiles
+            logger.info("Profiling started")
+            return True
+
+    async def stop(self, writer):
+        """ Stop the running session, and dump it. Return the path of the report, or None if no session is running """
+        async with self._lock:
+            if not self.active:
+                return None
+            profiles, self._profiles = self._profiles, None
+            profiles[0].disable()
+            if len(profiles) > 1:
+                await (await writer.submit(profiles[1].disable))
+            path = await asyncio.to_thread(self._dump, profiles)
+            logger.info("Profiling stopped: report written to {}".format(path))
+            return path
+
+    async def toggle(self, writer):
+        """ Start a session, or stop the running one """
+        if self.active:
+            await self.stop(writer)
+        else:
+            await self.start(writer)
+
+    def _dump(self, profiles):
+        """ Write the raw stats (.prof, for pstats / snakeviz) and a text report. Return the path of the report """
+        base = os.path.join(self.directory, "profile-{}-{:d}".format(self._started.strftime("%Y%m%dT%H%M%S"), os.getpid()))
+        stats = pstats.Stats(*profiles)
+        stats.dump_stats(base + ".prof")
+
+        out = io.StringIO()
+        duration = (datetime.now(UTC) - self._started).total_seconds()
+        out.write("Profiling session of {:.1f}s, started at {!s}\n\n".format(duration, self._started))
+        out.write("Cumulative time by stage (write includes checkpoint):\n")
+        times = stage_times(stats)
+        for stage in STAGE_FUNCTIONS:
+            out.write("  {:<12}{:10.3f}s\n".format(stage, times[stage]))
+        out.write("\n")
+        stats.stream = out
+        stats.sort_stats("cumulative").print_stats(PROFILE_TOP)
+        stats.sort_stats("tottime").print_stats(PROFILE_TOP)
+
+        with open(base + ".txt", "w", encoding="utf-8") as fd:
+            fd.write(out.getvalue())
+        return base + ".txt"
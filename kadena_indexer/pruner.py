@@ -0,0 +1,62 @@
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+PRUNE_CHUNK = 1000
+PRUNE_RATE = 5000
+PRUNE_LOG_PERIOD = 100000
+
+class Pruner:
+    """ Background job that deletes the events outside of the wanted ranges, by bounded chunks """
+
+    # The pruning queries (provided by the event store) are stateless: an interrupted pruning simply resumes at the next start.
+    # The wanted range is read from the coordinator before each chunk, so a range extended meanwhile is respected.
+    def __init__(self, store, coordinator, chunk=PRUNE_CHUNK, rate=PRUNE_RATE):
+        self.store = store
+        self.coordinator = coordinator
+        self.chunk = chunk
+        self.rate = rate
+        self._queue = asyncio.Queue()
+
+    def schedule(self, name, chain):
+        """ Schedule the pruning of an event on a chain """
+        self._queue.put_nowait((name, chain))
+
+    def _queries(self, name, chain):
+        wanted = self.coordinator.wanted[chain].get(name)
+        if wanted is None:
+            return []
+        return self.store.out_of_range_queries(name, chain, wanted.lower, wanted.upper)
+
+    def _delete_chunk(self, name, chain):
+        """ Delete a chunk of events. Return the number of deleted events """
+        coll = self.store.collection(self.store.collection_name(name))
+        for query, hint in self._queries(name, chain):
+            ids = [x["_id"] for x in coll.find(query, {"_id":1}).hint(hint).limit(self.chunk)]
+            if ids:
+                return coll.delete_many({"_id":{"$in":ids}}).deleted_count
+        return 0
+
+    async def _prune(self, name, chain):
+        total = 0
+        while True:
+            count = await asyncio.to_thread(self._delete_chunk, name, chain)
+            if not count:
+                break
+            if total // PRUNE_LOG_PERIOD != (total+count) // PRUNE_LOG_PERIOD:
+                logger.info("Pruning {:s}/{: <2}: {:d} events deleted".format(name, chain, total+count))
+            total += count
+            await asyncio.sleep(count / self.rate)
+
+        if total:
+            logger.info("Pruned {:d} events for {:s}/{: <2}".format(total, name, chain))
+
+    async def run(self):
+        """ Task that handles the scheduled prunings """
+        while True:
+            name, chain = await self._queue.get()
+            try:
+                await self._prune(name, chain)
+            except Exception as e: # pylint: disable=broad-except
+                logger.error("Error when pruning {:s}/{: <2}: {!s}".format(name, chain, e))
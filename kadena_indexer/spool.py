@@ -0,0 +1,194 @@
+import asyncio
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import bson
+
+logger = logging.getLogger(__name__)
+
+SEGMENT_SIZE = 64*1024*1024
+CURSOR_SAVE_PERIOD = 200
+
+def _read_records(fd):
+    """ Iterate over the BSON records of an opened segment file: yield (end_position, record) """
+    while True:
+        header = fd.read(4)
+        if len(header) < 4:
+            return
+        size = int.from_bytes(header, "little")
+        body = fd.read(size-4)
+        if len(body) < size-4:
+            return
+        yield fd.tell(), bson.decode(header+body)
+
+
+class Spool:
+    """ Local append-only write-ahead spool of decoded blocks """
+
+    # The spool is made of segment files (<seq>.seg) containing concatenated BSON records.
+    # The cursor file contains the position (seq, offset) following the last record
+    # written to MongoDB. Fully drained segments are deleted. The records which can't be
+    # written to MongoDB are moved to the quarantine file.
+    # Unless fsync is False, records are synced to the disk when appended: they survive a crash.
+    # The syncs run in a dedicated thread (in order with the closing of the full segments), and each one
+    # covers all the records appended before it starts (group commit).
+    def __init__(self, path, segment_size=SEGMENT_SIZE, fsync=True):
+        self.path = Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.segment_size = segment_size
+        self.fsync = fsync
+        self._new_data = asyncio.Event()
+        self._acks = 0
+        self._written = 0
+        self._synced = 0
+        self._sync_task = None
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="spool-sync")
+
+        self.cursor = self._load_cursor()
+        segments = self._segments()
+        self._seq = segments[-1] if segments else self.cursor[0]
+        self._truncate_incomplete(self._seq)
+        self._fd = open(self._segment_path(self._seq), "ab") # pylint: disable=consider-using-with
+        if self.fsync:
+            self._sync_dir()
+
+    def _segment_path(self, seq):
+        return self.path / "{:012d}.seg".format(seq)
+
+    def _segments(self):
+        return sorted(int(x.stem) for x in self.path.glob("*.seg"))
+
+    def _load_cursor(self):
+        try:
+            seq, offset = (self.path / "cursor").read_text().split()
+            return (int(seq), int(offset))
+        except FileNotFoundError:
+            return (0,0)
+
+    def _sync_dir(self):
+        """ Make the creation (or renaming) of the files durable """
+        fd = os.open(self.path, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def _save_cursor(self):
+        tmp = self.path / "cursor.tmp"
+        with open(tmp, "w", encoding="ascii") as fd:
+            fd.write("{:d} {:d}".format(*self.cursor))
+            fd.flush()
+            if self.fsync:
+                os.fsync(fd.fileno())
+        tmp.replace(self.path / "cursor")
+        if self.fsync:
+            self._sync_dir()
+
+    def _truncate_incomplete(self, seq):
+        """ Remove a partially written record at the end of a segment (after a crash) """
+        path = self._segment_path(seq)
+        if not path.exists():
+            return
+        end = 0
+        with open(path, "rb") as fd:
+            for end, _ in _read_records(fd):
+                pass
+        if end != path.stat().st_size:
+            logger.warning("Spool: truncating incomplete segment {:d} at {:d}".format(seq, end))
+            os.truncate(path, end)
+
+    def _close_segment(self, fd):
+        if self.fsync:
+            os.fsync(fd.fileno())
+        fd.close()
+        if self.fsync:
+            self._sync_dir()
+
+    async def _fsync(self):
+        target = self._written
+        try:
+            await asyncio.get_running_loop().run_in_executor(self._executor, os.fsync, self._fd.fileno())
+            self._synced = target
+        finally:
+            self._sync_task = None
+
+    async def _sync(self):
+        """ Wait until all the appended records are on the disk """
+        target = self._written
+        while self._synced < target:
+            if self._sync_task is None:
+                self._sync_task = asyncio.ensure_future(self._fsync())
+            # Shared by the other appenders: not cancelled with this one
+            await asyncio.shield(self._sync_task)
+
+    async def append(self, record):
+        """ Append a record at the end of the spool. Return once it is on the disk (unless fsync is False) """
+        full = None
+        if self._fd.tell() >= self.segment_size:
+            full = self._fd
+            self._seq += 1
+            self._fd = open(self._segment_path(self._seq), "ab") # pylint: disable=consider-using-with
+        # Written before any wait: the records are kept in the order of the calls
+        self._fd.write(bson.encode(record))
+        self._fd.flush()
+        self._written += 1
+        self._new_data.set()
+        if full is not None:
+            # After the syncs already started on the full segment
+            await asyncio.get_running_loop().run_in_executor(self._executor, self._close_segment, full)
+        if self.fsync:
+            await self._sync()
+
+    def quarantine(self, record):
+        """ Set aside a record that can't be written to the DB """
+        with open(self.path / "quarantine.bson", "ab") as fd:
+            fd.write(bson.encode(record))
+            fd.flush()
+            os.fsync(fd.fileno())
+
+    def pending(self):
+        """ Iterate over the records not drained yet (synchronous, used at startup) """
+        for seq in self._segments():
+            if seq < self.cursor[0]:
+                continue
+            with open(self._segment_path(seq), "rb") as fd:
+                if seq == self.cursor[0]:
+                    fd.seek(self.cursor[1])
+                for _, rec in _read_records(fd):
+                    yield rec
+
+    async def read(self):
+        """ Iterate over the records not drained yet: yield (position, record). Wait for new records when the end is reached """
+        seq, offset = self.cursor
+        while True:
+            path = self._segment_path(seq)
+            if path.exists():
+                with open(path, "rb") as fd:
+                    fd.seek(offset)
+                    for offset, rec in _read_records(fd):
+                        yield (seq, offset), rec
+
+            if seq < self._seq:
+                seq, offset = seq+1, 0
+            else:
+                self._new_data.clear()
+                await self._new_data.wait()
+
+    def ack(self, position):
+        """ Notify that all the records up to position have been written to the DB """
+        previous_seq = self.cursor[0]
+        self.cursor = position
+        self._acks += 1
+        if position[0] != previous_seq or self._acks % CURSOR_SAVE_PERIOD == 0:
+            self._save_cursor()
+            for seq in self._segments():
+                if seq < position[0]:
+                    self._segment_path(seq).unlink()
+
+    def close(self):
+        """ Save the cursor and close the current segment """
+        self._executor.shutdown(wait=True)
+        self._save_cursor()
+        self._close_segment(self._fd)
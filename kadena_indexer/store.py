@@ -0,0 +1,108 @@
+import logging
+
+from pymongo import IndexModel, ASCENDING
+from pymongo.errors import CollectionInvalid
+
+logger = logging.getLogger(__name__)
+
+MAX_RANK = (1<<20) - 1
+
+def event_key(chain, height, rank):
+    """ Encode (chain, height, rank) into an integer ordered by chain, then height, then rank:
+        chain: 11 bits, height: 32 bits, rank: 20 bits """
+    return (int(chain) << 52) | (height << 20) | rank
+
+
+class EventStore:
+    """ Routing layer between the indexer and the events collections """
+
+    # Two layouts are supported:
+    #  - One collection per event (default). Collections can be clustered, keyed by event_key(chain, height, rank):
+    #    the clustered index replaces st_prune, and chain/height range scans become sequential reads.
+    #  - Partitioned: events are stored in a few partition collections, discriminated by name.
+    #    All the indexes lead with name, and a view named after each event keeps the readers working unchanged.
+    def __init__(self, db, clustered=False, block_compressor="zstd", partition=None):
+        if clustered and partition:
+            raise ValueError("clustered_collections and partitioned are mutually exclusive")
+        self.db = db
+        self.clustered = clustered
+        self.block_compressor = block_compressor
+        self.partition = partition
+        self.routes = {}
+        self._clustered = {}
+
+    def route(self, name, partition=None):
+        """ Declare an event, and the partition it must be stored in (partitioned layout only) """
+        self.routes[name] = (partition or self.partition) if self.partition else name
+
+    def unroute(self, name):
+        """ Forget an event (removed from the config). Its collection is left as is """
+        self.routes.pop(name, None)
+
+    def collection_name(self, name):
+        """ Return the name of the collection where an event is stored """
+        return self.routes.get(name, name)
+
+    def collections(self):
+        """ Return the names of all the events collections """
+        return sorted(set(self.routes.values()))
+
+    def events_of(self, coll_name):
+        """ Return the events stored in a collection """
+        return [name for name, coll in self.routes.items() if coll == coll_name]
+
+    def key_prefix(self):
+        """ Return the keys that must lead all the indexes """
+        return [("name", ASCENDING)] if self.partition else []
+
+    def _create_views(self, coll_name):
+        existing = {x["name"]:x["type"] for x in self.db.list_collections()}
+        for name in self.events_of(coll_name):
+            if name not in existing:
+                logger.info("{} => Creating view on {}".format(name, coll_name))
+                try:
+                    self.db.create_collection(name, viewOn=coll_name, pipeline=[{"$match":{"name":name}}])
+                except CollectionInvalid:
+                    # Created meanwhile by another indexer process
+                    pass
+            elif existing[name] != "view":
+                # Readers would keep reading the old collection, while the events are written to the partition
+                raise ValueError("{} => A collection exists with this name: no view on {} can be created. "
+                                 "Move its documents to the partition and drop it (or rename it) first".format(name, coll_name))
+
+    def prepare(self, coll_name):
+        """ Create an events collection (and its views) if it doesn't exist yet """
+        if coll_name not in self._clustered:
+            if self.partition:
+                self._create_views(coll_name)
+            elif self.clustered and coll_name not in self.db.list_collection_names():
+                logger.info("{} => Creating clustered collection".format(coll_name))
+                try:
+                    self.db.create_collection(coll_name, clusteredIndex={"key":{"_id":1}, "unique":True},
+                                              storageEngine={"wiredTiger":{"configString":"block_compressor="+self.block_compressor}})
+                except CollectionInvalid:
+                    pass
+            self._clustered[coll_name] = "clusteredIndex" in self.db[coll_name].options()
+
+    def is_clustered(self, name):
+        """ Return true if an event is stored in a clustered collection """
+        return self._clustered.get(self.collection_name(name)) or False
+
+    def collection(self, coll_name, write_concern=None):
+        """ Return an events collection """
+        return self.db.get_collection(coll_name, write_concern=write_concern)
+
+    def required_indexes(self, coll_name):
+        """ Return the indexes of a collection needed by the indexer itself """
+        if self._clustered.get(coll_name):
+            return []
+        return [IndexModel(self.key_prefix() + [("chain", ASCENDING), ("height", ASCENDING)], name="st_prune")]
+
+    def out_of_range_queries(self, name, chain, lower, upper):
+        """ Return the (query, hint) of the events of a chain below lower, and above upper """
+        if self.is_clustered(name):
+            return [({"_id":{"$gte":event_key(chain, 0, 0), "$lt":event_key(chain, lower, 0)}}, None),
+                    ({"_id":{"$gt":event_key(chain, upper, MAX_RANK), "$lt":event_key(int(chain)+1, 0, 0)}}, None)]
+        name_filter = {"name":name} if self.partition else {}
+        return [(dict(name_filter, chain=chain, height={"$lt":lower}), "st_prune"),
+                (dict(name_filter, chain=chain, height={"$gt":upper}), "st_prune")]
@@ -0,0 +1,116 @@
+import asyncio
+import logging
+import multiprocessing
+import os
+import queue
+import signal
+import sys
+import time
+from collections import Counter
+
+import yaml
+
+from .indexer import Indexer
+
+logger = logging.getLogger(__name__)
+
+RESTART_DELAY = 10.0
+SHUTDOWN_TIMEOUT = 60.0
+STATS_LOG_PERIOD = 60.0
+
+def worker_main(config_file, chains, stats_queue, log_level, options):
+    """ Entry point of an indexer process. options: other keyword arguments of the Indexer """
+    logging.basicConfig(encoding='utf-8', format='%(asctime)s:%(levelname)s:%(processName)s:%(name)s => %(message)s', level=log_level)
+    idx = Indexer(config_file, chains=chains, stats_queue=stats_queue, **options)
+    asyncio.run(idx.run())
+
+
+class Supervisor:
+    """ Runs several indexer processes, each one owning a disjoint subset of the chains """
+
+    # The coordinator state is shared through MongoDB: each process only reads and writes its own chains.
+    def __init__(self, config_file, workers, log_level=logging.INFO, drop_stale_indexes=False):
+        self.config_file = config_file
+        self.log_level = log_level
+        self.drop_stale_indexes = drop_stale_indexes
+        self._ctx = multiprocessing.get_context("spawn")
+        self._stats_queue = self._ctx.Queue()
+        self._stats = {}
+        self._procs = {}
+
+        with open(config_file, "rb") as fd:
+            config = yaml.safe_load(fd)
+        chains = sorted({str(c) for ev in config["events"] for c in ev["chains"]}, key=int)
+        self.groups = [tuple(chains[i::workers]) for i in range(min(workers, len(chains)))]
+        if len(self.groups) > 1 and config.get("live_mode", "blocks") == "blocks":
+            # Each process downloads and parses the blocks of all the chains
+            logger.warning("live_mode: blocks with {:d} workers: the whole blocks stream is read {:d} times (live_mode: headers is recommended)"
+                           .format(len(self.groups), len(self.groups)))
+
+    def _start(self, chains):
+        logger.info("Starting indexer for chains {!s}".format(",".join(chains)))
+        options = {"drop_stale_indexes":self.drop_stale_indexes, "worker_id":self.groups.index(chains)}
+        proc = self._ctx.Process(target=worker_main, args=(self.config_file, list(chains), self._stats_queue, self.log_level, options),
+                                 name="indexer-"+"-".join(chains))
+        proc.start()
+        self._procs[chains] = (proc, time.monotonic())
+
+    def _check_workers(self):
+        """ Restart the crashed workers (not too fast) """
+        for chains, (proc, started) in list(self._procs.items()):
+            if not proc.is_alive():
+                if time.monotonic() - started < RESTART_DELAY:
+                    continue
+                logger.error("Indexer for chains {!s} exited with code {!s}: restarting".format(",".join(chains), proc.exitcode))
+                self._start(chains)
+
+    def _collect_stats(self):
+        try:
+            while True:
+                chains, stats = self._stats_queue.get_nowait()
+                self._stats[tuple(chains)] = stats
+        except queue.Empty:
+            pass
+
+    def _log_stats(self):
+        total = sum(map(Counter, self._stats.values()), Counter())
+        logger.info("Stats ({:d} workers): {!s}".format(len(self._procs), ", ".join("{}={}".format(k, v) for k, v in sorted(total.items()))))
+
+    def _terminate(self, *_args):
+        """ SIGTERM handler: forward the signal to the workers """
+        for proc, _ in self._procs.values():
+            if proc.is_alive():
+                proc.terminate()
+        sys.exit(0)
+
+    def _forward(self, signum, _frame):
+        """ SIGHUP (config reload) and SIGUSR1 (profiling) handler: forward the signal to the workers """
+        for proc, _ in self._procs.values():
+            if proc.is_alive():
+                os.kill(proc.pid, signum)
+
+    def run(self):
+        """ Start the workers, and supervise them until interrupted """
+        signal.signal(signal.SIGTERM, self._terminate)
+        signal.signal(signal.SIGHUP, self._forward)
+        signal.signal(signal.SIGUSR1, self._forward)
+        for chains in self.groups:
+            self._start(chains)
+
+        last_log = time.monotonic()
+        try:
+            while True:
+                time.sleep(1.0)
+                self._check_workers()
+                self._collect_stats()
+                if time.monotonic() - last_log > STATS_LOG_PERIOD:
+                    self._log_stats()
+                    last_log = time.monotonic()
+        except KeyboardInterrupt:
+            # Workers belong to the same process group: they have been interrupted too
+            logger.info("Stopping workers")
+        finally:
+            for proc, _ in self._procs.values():
+                proc.join(SHUTDOWN_TIMEOUT)
+                if proc.is_alive():
+                    proc.terminate()
@@ -0,0 +1,67 @@
+import importlib
+import json
+import logging
+import random
+import threading
+import time
+from collections import namedtuple
+
+logger = logging.getLogger(__name__)
+
+# Stages of a block, in order
+STAGES = ("fetch", "parse", "decode", "filter", "write", "checkpoint")
+
+# A spooled block, as traced (see Tracer.record). timings: {stage:seconds}, size: payload bytes
+BlockTrace = namedtuple("BlockTrace", ["chain", "height", "timings", "size"])
+
+class JsonLinesExporter:
+    """ Export the traces as JSON lines to a file. Can be called from any thread """
+    def __init__(self, path):
+        self._fd = open(path, "a", encoding="utf-8") # pylint: disable=consider-using-with
+        self._lock = threading.Lock()
+
+    def __call__(self, trace):
+        line = json.dumps(trace, separators=(",", ":")) + "\n"
+        with self._lock:
+            self._fd.write(line)
+            self._fd.flush()
+
+    def close(self):
+        """ Close the file """
+        self._fd.close()
+
+
+def load_exporter(cfg):
+    """ Create the exporter from the config: either a JSON lines file (path), or a custom one (exporter: module:factory),
+        the factory being called with the config and returning a callable(trace) """
+    if cfg.get("exporter"):
+        module, _, factory = cfg["exporter"].partition(":")
+        return getattr(importlib.import_module(module), factory)(cfg)
+    return JsonLinesExporter(cfg["path"])
+
+
+class Tracer:
+    """ Exports the durations of the stages of a sample of the indexed blocks """
+
+    # The stages durations are always measured (see ChainWebBlock.timings): it's only a few clock reads per block.
+    # The sampling only decides which blocks are exported.
+    def __init__(self, exporter, sample_rate=1.0):
+        self.exporter = exporter
+        self.sample_rate = sample_rate
+
+    def record(self, block, live, events):
+        """ Export the trace of an indexed block (when sampled): a ChainWebBlock or a BlockTrace """
+        if self.sample_rate < 1.0 and random.random() >= self.sample_rate:
+            return
+        trace = {"ts":round(time.time(), 3), "chain":block.chain, "height":block.height, "mode":"live" if live else "backfill",
+                 "events":events, "payload_bytes":block.size,
+                 "stages":{stage:round(block.timings[stage]*1000.0, 3) for stage in STAGES if stage in block.timings}}
+        try:
+            self.exporter(trace)
+        except Exception as e: # pylint: disable=broad-except
+            logger.error("Error when exporting trace: {!s}".format(e))
+
+    def close(self):
+        """ Close the exporter (if it can be closed) """
+        if hasattr(self.exporter, "close"):
+            self.exporter.close()
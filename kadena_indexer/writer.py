@@ -0,0 +1,71 @@
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+WRITE_QUEUE_SIZE = 64
+
+class Writer:
+    """ Runs the (synchronous) MongoDB writes in a dedicated thread, fed by asyncio queues """
+
+    # Jobs are executed one by one. The event loop only waits when a queue is full, so fetching,
+    # parsing and committing overlap. There are two queues: live jobs always go ahead of the backfill
+    # ones, and are executed in submission order (as the backfill ones).
+    def __init__(self, queue_size=WRITE_QUEUE_SIZE):
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="mongo-writer")
+        self._queues = {True:asyncio.Queue(queue_size), False:asyncio.Queue(queue_size)}
+        self._ready = asyncio.Event()
+        self._task = None
+
+    async def __aenter__(self):
+        self._task = asyncio.create_task(self._run())
+        return self
+
+    async def __aexit__(self, *args):
+        for q in self._queues.values():
+            await q.join()
+        self._task.cancel()
+        self._executor.shutdown(wait=True)
+
+    @property
+    def depth(self):
+        """ Number of jobs waiting in the queues """
+        return sum(q.qsize() for q in self._queues.values())
+
+    def queue_depth(self, live):
+        """ Number of live (or backfill) jobs waiting """
+        return self._queues[live].qsize()
+
+    async def submit(self, func, *args, live=True):
+        """ Queue a write job, and return a future resolved when the job has been executed """
+        fut = asyncio.get_running_loop().create_future()
+        await self._queues[live].put((fut, func, args))
+        self._ready.set()
+        return fut
+
+    async def _next_job(self):
+        while True:
+            for q in self._queues.values():
+                if not q.empty():
+                    return q, q.get_nowait()
+            self._ready.clear()
+            await self._ready.wait()
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            q, (fut, func, args) = await self._next_job()
+            try:
+                res = await loop.run_in_executor(self._executor, func, *args)
+            except Exception as e: # pylint: disable=broad-except
+                logger.error("Write job failed: {!s}".format(e))
+                if not fut.cancelled():
+                    fut.set_exception(e)
+                    # The error has been logged: don't complain again if nobody awaits the future
+                    fut.exception()
+            else:
+                if not fut.cancelled():
+                    fut.set_result(res)
+            finally:
+                q.task_done()
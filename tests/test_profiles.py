@@ -0,0 +1,28 @@
+from easydict import EasyDict
+from pymongo import MongoClient, WriteConcern
+
+from kadena_indexer.indexer import Indexer
+
+URI = "mongodb://localhost:27017/?w=majority&journal=true"
+
+def load_profiles(durability):
+    idx = Indexer.__new__(Indexer)
+    idx.config = EasyDict({"durability":durability} if durability is not None else {})
+    return idx._load_profiles() # pylint: disable=protected-access
+
+def test_uri_write_concern_is_kept():
+    client = MongoClient(URI, connect=False)
+    coll = client.db.coordinator
+    for durability in (None, {}, {"live":{}, "backfill":{"checkpoint":200}}):
+        profiles = load_profiles(durability)
+        for profile in profiles.values():
+            assert profile.write_concern is None
+            assert coll.with_options(write_concern=profile.write_concern).write_concern == WriteConcern(w="majority", j=True)
+            assert client.db.get_collection("ev", write_concern=profile.write_concern).write_concern == WriteConcern(w="majority", j=True)
+
+def test_configured_write_concern():
+    profiles = load_profiles({"live":{"w":"majority", "j":True}, "backfill":{"w":1, "checkpoint":200}})
+    assert profiles[True].write_concern == WriteConcern(w="majority", j=True)
+    assert profiles[False].write_concern == WriteConcern(w=1)
+    assert profiles[False].checkpoint == 200
+    assert profiles[True].checkpoint == 1
@@ -0,0 +1,36 @@
+import asyncio
+import pstats
+
+from kadena_indexer.profiling import Profiler
+from kadena_indexer.writer import Writer
+
+def busy(n):
+    return sum(i*i for i in range(n))
+
+def check_report(path):
+    with open(path, encoding="utf-8") as fd:
+        assert "Cumulative time by stage" in fd.read()
+    # Both threads are profiled: the event loop, and the writer
+    stats = pstats.Stats(path[:-len(".txt")] + ".prof")
+    assert [calls for (_, _, func), (calls, *_) in stats.stats.items() if func == "busy"] == [2]
+
+def test_session(tmp_path):
+    async def main():
+        profiler = Profiler(str(tmp_path))
+        async with Writer() as writer:
+            assert await profiler.start(writer)
+            assert not await profiler.start(writer)
+            await (await writer.submit(busy, 10000))
+            busy(10000)
+            # Duplicate (concurrent) stops: only one of them dumps the session
+            path, other = await asyncio.gather(profiler.stop(writer), profiler.stop(writer))
+            assert other is None
+            assert not profiler.active
+            assert await profiler.stop(writer) is None
+            check_report(path)
+
+            # A new session can be started afterwards
+            assert await profiler.start(writer)
+            assert await profiler.stop(writer) is not None
+
+    asyncio.run(main())
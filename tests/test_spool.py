@@ -0,0 +1,67 @@
+import asyncio
+
+import bson
+
+from kadena_indexer.spool import Spool
+
+def records(n, start=0):
+    return [{"chain":"0", "height":h, "events":[{"name":"coin.TRANSFER", "params":["a", "b", h]}]} for h in range(start, start+n)]
+
+async def append_all(spool, recs):
+    # Concurrent appends share their fsyncs
+    await asyncio.gather(*(spool.append(rec) for rec in recs))
+
+async def read_n(spool, n):
+    result = []
+    async for position, rec in spool.read():
+        result.append((position, rec))
+        if len(result) == n:
+            return result
+    return result
+
+def heights(recs):
+    return [rec["height"] for rec in recs]
+
+def test_incomplete_record_is_truncated(tmp_path):
+    spool = Spool(tmp_path)
+    asyncio.run(append_all(spool, records(3)))
+    spool.close()
+    # Crash in the middle of a record
+    with open(tmp_path / "000000000000.seg", "ab") as fd:
+        fd.write(bson.encode(records(1, 3)[0])[:10])
+
+    spool = Spool(tmp_path)
+    assert heights(spool.pending()) == [0, 1, 2]
+    asyncio.run(append_all(spool, records(1, 3)))
+    assert heights(spool.pending()) == [0, 1, 2, 3]
+    spool.close()
+
+def test_replay_after_ack(tmp_path):
+    spool = Spool(tmp_path)
+    async def main():
+        await append_all(spool, records(5))
+        drained = await read_n(spool, 5)
+        spool.ack(drained[2][0])
+    asyncio.run(main())
+    spool.close()
+
+    # The records not acknowledged are replayed
+    spool = Spool(tmp_path)
+    assert heights(spool.pending()) == [3, 4]
+    assert heights(rec for _, rec in asyncio.run(read_n(spool, 2))) == [3, 4]
+    spool.close()
+
+def test_drained_segments_are_deleted(tmp_path):
+    spool = Spool(tmp_path, segment_size=200)
+    async def main():
+        await append_all(spool, records(10))
+        drained = await read_n(spool, 10)
+        assert heights(rec for _, rec in drained) == list(range(10))
+        segments = sorted(tmp_path.glob("*.seg"))
+        assert len(segments) > 2
+        spool.ack(drained[-1][0])
+        return segments
+    segments = asyncio.run(main())
+    assert sorted(tmp_path.glob("*.seg")) == segments[-1:]
+    spool.close()
+    assert not list(Spool(tmp_path).pending())